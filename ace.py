@@ -2,7 +2,27 @@ import ast
 import operator
 import math
 import re
-from timeout import timeout
+import os
+import asyncio
+import resource
+import multiprocessing
+from functools import lru_cache
+
+# Expressions are evaluated in pre-forked worker processes, a worker that runs out of time is killed and replaced
+EVAL_WORKERS = int(os.environ.get('ACE_WORKERS', '2'))
+EVAL_TIMEOUT = float(os.environ.get('ACE_TIMEOUT', '2'))
+# Address space a worker may grow by over what it inherits from the bot, and CPU seconds per evaluation
+EVAL_MEMORY_MB = int(os.environ.get('ACE_MEMORY_MB', '256'))
+EVAL_CPU_SECONDS = int(os.environ.get('ACE_CPU_SECONDS', '3'))
+
+_idle_workers = None
+
+# Compiled expressions kept per process, and the static limits an expression has to pass before it runs
+EVAL_CACHE_SIZE = int(os.environ.get('ACE_CACHE_SIZE', '256'))
+MAX_RESULT_BITS = int(os.environ.get('ACE_MAX_BITS', str(1 << 20)))
+MAX_CALL_DEPTH = 10
+MAX_NODES = 200
+FLOAT_BITS = 1024  # floats never exceed 2**1024, an overflow raises or gives inf right away
 
 allowed_operators = {
     ast.Add: operator.add,
@@ -29,45 +49,201 @@ allowed_functions = {
     'round': round
 }
 
+def _int_bits(value):
+    # log2 of the magnitude, 0 for |value| <= 1
+    return math.log2(abs(value)) if abs(value) > 1 else 0.0
+
+
+def _pow_bits(base_bits, exponent_bits):
+    # |base| <= 1 stays there whatever the exponent, otherwise the result has base_bits * exponent bits
+    if base_bits <= 0:
+        return 0.0
+    if exponent_bits >= FLOAT_BITS:
+        return math.inf
+    return base_bits * 2 ** exponent_bits
+
+
+def _compile(node, call_depth=0):
+    """
+    Compiles a node into a closure that evaluates it, together with an upper bound on log2 of its magnitude
+    (its bit length) and whether the value can be an int. Only ints can grow without bound, so only those are limited.
+    """
+    func, bits, is_int = _compile_node(node, call_depth)
+    if is_int and bits > MAX_RESULT_BITS:
+        raise ValueError(f"Too expensive to compute, {ast.unparse(node)[:50]} could have up to {bits:.0f} bits "
+                         f"(max {MAX_RESULT_BITS})")
+    return func, bits, is_int
+
+
+def _compile_node(node, call_depth):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float, complex):  # <number>
+        value = node.value
+        if type(value) is int:
+            return (lambda: value), _int_bits(value), True
+        return (lambda: value), FLOAT_BITS, False
+    elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
+        op_type = type(node.op)
+        if op_type not in allowed_operators:
+            raise ValueError(f"Unsupported operator: {op_type}")
+        op = allowed_operators[op_type]
+        left, left_bits, left_int = _compile(node.left, call_depth)
+        right, right_bits, right_int = _compile(node.right, call_depth)
+        is_int = left_int and right_int
+        if op_type is ast.Div or not is_int:
+            bits = FLOAT_BITS
+        elif op_type is ast.Mult:
+            bits = left_bits + right_bits
+        elif op_type is ast.Pow:
+            bits = _pow_bits(left_bits, right_bits)
+        else:
+            bits = max(left_bits, right_bits) + 1
+        return (lambda: op(left(), right())), bits, is_int and op_type is not ast.Div
+    elif isinstance(node, ast.UnaryOp):  # - <operand>
+        op_type = type(node.op)
+        if op_type not in allowed_operators:
+            raise ValueError(f"Unsupported unary operator: {op_type}")
+        op = allowed_operators[op_type]
+        operand, bits, is_int = _compile(node.operand, call_depth)
+        return (lambda: op(operand())), bits, is_int
+    elif isinstance(node, ast.Call):  # Function calls like sin(x)
+        func_name = node.func.id if isinstance(node.func, ast.Name) else None
+        if func_name not in allowed_functions:
+            raise ValueError(f"Unsupported function: {func_name or ast.unparse(node.func)}")
+        if node.keywords:
+            raise ValueError(f"Unsupported keyword arguments for {func_name}")
+        if call_depth >= MAX_CALL_DEPTH:
+            raise ValueError(f"Too deeply nested function calls (max {MAX_CALL_DEPTH})")
+        func = allowed_functions[func_name]
+        compiled = [_compile(arg, call_depth + 1) for arg in node.args]
+        args = [arg for arg, _, _ in compiled]
+        bits = max((arg_bits for _, arg_bits, _ in compiled), default=0.0)
+        # abs, max, min, floor, ceil and round keep an int an int (or make one from a float), the rest give floats
+        is_int = func_name in ('abs', 'max', 'min', 'floor', 'ceil', 'round')
+        return (lambda: func(*[arg() for arg in args])), bits if is_int else FLOAT_BITS, is_int
+    elif isinstance(node, ast.Name):
+        if node.id in ('pi', 'e'):
+            value = getattr(math, node.id)
+            return (lambda: value), FLOAT_BITS, False
+        else:
+            raise ValueError(f"Unknown variable: {node.id}")
+    else:
+        raise ValueError(f"Unsupported expression: {node}")
+
+
+@lru_cache(maxsize=EVAL_CACHE_SIZE)
+def compile_expression(expr):
+    """
+    Parses the expression and compiles it into a closure once, rejecting it before it ever runs if it could
+    produce an int longer than MAX_RESULT_BITS anywhere along the way.
+    """
+    tree = ast.parse(expr, mode='eval')
+    if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+        raise ValueError(f"Expression is too long (max {MAX_NODES} nodes)")
+
+    func, _, _ = _compile(tree.body)
+    return func
+
+
+def normalize_expression(expr):
+    return " ".join(expr.split())
+
+
 def safe_eval(expr):
     """
     Safely evaluate a mathematical expression using AST parsing.
     """
-    def _eval(node):
-        if isinstance(node, ast.Num):  # <number>
-            return node.n
-        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-            left = _eval(node.left)
-            right = _eval(node.right)
-            op_type = type(node.op)
-            if op_type in allowed_operators:
-                return allowed_operators[op_type](left, right)
-            else:
-                raise ValueError(f"Unsupported operator: {op_type}")
-        elif isinstance(node, ast.UnaryOp):  # - <operand>
-            operand = _eval(node.operand)
-            op_type = type(node.op)
-            if op_type in allowed_operators:
-                return allowed_operators[op_type](operand)
-            else:
-                raise ValueError(f"Unsupported unary operator: {op_type}")
-        elif isinstance(node, ast.Call):  # Function calls like sin(x)
-            func_name = node.func.id
-            if func_name in allowed_functions:
-                args = [_eval(arg) for arg in node.args]
-                return allowed_functions[func_name](*args)
-            else:
-                raise ValueError(f"Unsupported function: {func_name}")
-        elif isinstance(node, ast.Name):
-            if node.id in ('pi', 'e'):
-                return getattr(math, node.id)
-            else:
-                raise ValueError(f"Unknown variable: {node.id}")
-        else:
-            raise ValueError(f"Unsupported expression: {node}")
+    return compile_expression(normalize_expression(expr))()
+
+
+class EvalError(Exception):
+    pass
+
+
+def _limit_memory():
+    # The forked worker already maps everything the bot had loaded, so the limit is relative to that
+    with open('/proc/self/statm') as statm:
+        current = int(statm.read().split()[0]) * resource.getpagesize()
+    limit = current + EVAL_MEMORY_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _eval_worker(conn):
+    _limit_memory()
+    while True:
+        try:
+            expression = conn.recv()
+        except EOFError:
+            return
+        # RLIMIT_CPU counts the whole life of the process, so every evaluation gets a fresh allowance on top
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + EVAL_CPU_SECONDS, hard))
+        try:
+            conn.send((True, str(safe_eval(expression))))
+        except Exception as e:
+            conn.send((False, str(e) or type(e).__name__))
+
+
+class EvalWorker:
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_eval_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    async def evaluate(self, expression, timeout):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            self.conn.send(expression)
+            await asyncio.wait_for(ready, timeout)
+        finally:
+            loop.remove_reader(fd)
+        return self.conn.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def start_eval_workers():
+    global _idle_workers
+    if _idle_workers is None:
+        _idle_workers = asyncio.Queue()
+        for _ in range(EVAL_WORKERS):
+            _idle_workers.put_nowait(EvalWorker())
+
+
+async def evaluate(expression):
+    """
+    Evaluates the expression in a worker process, raises TimeoutError when it takes longer than EVAL_TIMEOUT
+    (or the worker dies on its limits) and EvalError when the expression itself fails.
+    """
+    # Expressions that are invalid or too expensive are rejected here without taking up a worker
+    try:
+        compile_expression(normalize_expression(expression))
+    except Exception as e:
+        raise EvalError(str(e)) from e
 
-    node = ast.parse(expr, mode='eval').body
-    return _eval(node)
+    start_eval_workers()
+    worker = await _idle_workers.get()
+    try:
+        ok, result = await worker.evaluate(expression, EVAL_TIMEOUT)
+    except BaseException as e:
+        # The worker may still be busy with the expression, only a new one is safe to reuse
+        worker.kill()
+        worker = EvalWorker()
+        if isinstance(e, (EOFError, OSError)):
+            raise TimeoutError from e
+        raise
+    finally:
+        _idle_workers.put_nowait(worker)
+    if not ok:
+        raise EvalError(result)
+    return result
 
 
 async def try_handle_ace(message):
@@ -78,9 +254,8 @@ async def try_handle_ace(message):
             expression = match.group(1)
             expression = expression.replace('^', '**')
             try:
-                with timeout(seconds=5):
-                    result = safe_eval(expression)
-                    await message.reply(f"> {result}")
+                result = await evaluate(expression)
+                await message.reply(f"> {result}")
             except TimeoutError:
                 await message.reply("Error: Evaluation timed out.")
             except Exception as e:
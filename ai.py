@@ -1,17 +1,224 @@
 from ollama import AsyncClient
+import os
+import time
+import asyncio
 import logging
 import re
+from collections import OrderedDict, deque
+
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'http://ollama:11434')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'deepseek-r1:1.5b')
+# Generations running on the model server at once, and mentions allowed to wait for a turn on top of that
+AI_MAX_IN_FLIGHT = int(os.environ.get('AI_MAX_IN_FLIGHT', '1'))
+AI_MAX_QUEUED = int(os.environ.get('AI_MAX_QUEUED', '4'))
+STREAM_EDIT_INTERVAL = float(os.environ.get('AI_STREAM_EDIT_INTERVAL', '1.5'))
+MAX_MESSAGE_LENGTH = 2000
+AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', '128'))
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', '600'))
+# Conversation history sent along with each prompt, per channel
+AI_HISTORY_TOKENS = int(os.environ.get('AI_HISTORY_TOKENS', '1500'))
+AI_HISTORY_CHANNELS = int(os.environ.get('AI_HISTORY_CHANNELS', '100'))
+AI_HISTORY_IDLE = float(os.environ.get('AI_HISTORY_IDLE', '3600'))
+# How long ollama keeps the model loaded after a request, so the next mention doesn't wait for a cold load
+AI_KEEP_ALIVE = os.environ.get('AI_KEEP_ALIVE', '30m')
+
+_client = None
+_generation_slots = asyncio.Semaphore(AI_MAX_IN_FLIGHT)
+_admitted = 0
+# Prompt key -> future of the generation in progress, identical prompts wait for it instead of generating again
+_in_flight = {}
+
+class ResponseCache:
+    """
+    LRU map of normalized prompt to the cleaned answer and how long generating it took, entries expire after ttl.
+    Also counts what the cache and the request coalescing saved.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.saved_seconds = 0.0
+
+    def __len__(self):
+        return len(self._responses)
+
+    def get(self, key):
+        entry = self._responses.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._responses.pop(key, None)
+            self.misses += 1
+            return None
+        self._responses.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry[2]
+        return entry[1]
+
+    def put(self, key, text, generation_seconds):
+        self._responses[key] = (time.monotonic() + self.ttl, text, generation_seconds)
+        self._responses.move_to_end(key)
+        if len(self._responses) > self.max_size:
+            self._responses.popitem(last=False)
+
+response_cache = ResponseCache(AI_CACHE_SIZE, AI_CACHE_TTL)
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+class ConversationHistory:
+    """
+    Rolling history of the conversation with the bot in each channel. A channel keeps its latest exchanges within
+    max_tokens (estimated at 4 characters per token), older exchanges are dropped and a single overlong one is cut.
+    Channels idle for idle_seconds are forgotten, as are the least recently used ones beyond max_channels.
+    """
+    def __init__(self, max_tokens, max_channels, idle_seconds):
+        self.max_tokens = max_tokens
+        self.max_channels = max_channels
+        self.idle_seconds = idle_seconds
+        # channel id -> [last used, deque of ((question, answer), tokens), total tokens]
+        self._channels = OrderedDict()
+
+    def __len__(self):
+        return len(self._channels)
+
+    def _evict_idle(self, now):
+        while self._channels:
+            channel_id, (last_used, _, _) = next(iter(self._channels.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._channels[channel_id]
+
+    def get(self, channel_id):
+        self._evict_idle(time.monotonic())
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return []
+        return [message for exchange, _ in channel[1] for message in exchange]
+
+    def add_exchange(self, channel_id, content, answer):
+        now = time.monotonic()
+        self._evict_idle(now)
+        # An overlong question is cut to half the budget and the answer to what is left, so the exchange always fits
+        content = content[:max(self.max_tokens // 2 - 1, 0) * 4]
+        answer = answer[:max(self.max_tokens - estimate_tokens(content) - 1, 0) * 4]
+        exchange = ({'role': 'user', 'content': content}, {'role': 'assistant', 'content': answer})
+        tokens = estimate_tokens(content) + estimate_tokens(answer)
+        channel = self._channels.setdefault(channel_id, [now, deque(), 0])
+        channel[0] = now
+        channel[1].append((exchange, tokens))
+        channel[2] += tokens
+        # Whole exchanges are dropped, so the history never starts with an answer to a question it no longer has
+        while channel[2] > self.max_tokens:
+            channel[2] -= channel[1].popleft()[1]
+        self._channels.move_to_end(channel_id)
+        if len(self._channels) > self.max_channels:
+            self._channels.popitem(last=False)
+
+conversation_history = ConversationHistory(AI_HISTORY_TOKENS, AI_HISTORY_CHANNELS, AI_HISTORY_IDLE)
+
+def normalize_prompt(content, history=()):
+    # The same prompt after a different conversation needs a different answer
+    fingerprint = hash(tuple(message['content'] for message in history))
+    return fingerprint, " ".join(content.lower().split()).rstrip(".!?")
+
+def get_client():
+    # One long-lived client, so the HTTP connection to ollama is reused between mentions
+    global _client
+    if _client is None:
+        _client = AsyncClient(host=OLLAMA_HOST)
+    return _client
 
 def clean_response(response):
-    return re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL).strip()
+    response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL)
+    # While streaming the think section may still be open, none of it is shown
+    think_start = response.find("<think>")
+    if think_start != -1:
+        response = response[:think_start]
+    return response.strip()[:MAX_MESSAGE_LENGTH]
+
+async def stream_reply(message, messages):
+    """
+    Streams the completion and edits the reply as the answer grows, at most every STREAM_EDIT_INTERVAL seconds.
+    Nothing is sent before the think section has ended. Returns the full response.
+    """
+    response = ''
+    reply = None
+    shown = ''
+    last_edit = 0.0
+    async for part in await get_client().chat(model=OLLAMA_MODEL, messages=messages, stream=True,
+                                                 keep_alive=AI_KEEP_ALIVE):
+        response += part.message.content
+        text = clean_response(response)
+        if text and text != shown and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            if reply is None:
+                reply = await message.reply(text)
+            else:
+                await reply.edit(content=text)
+            shown, last_edit = text, time.monotonic()
+
+    text = clean_response(response) or '🤔'
+    if reply is None:
+        await message.reply(text)
+    elif text != shown:
+        await reply.edit(content=text)
+    return response
 
 async def try_handle_ai(client, message):
+    global _admitted
     mention = f"<@{client.user.id}>"
     mention_alt = f"<@!{client.user.id}>"
     if mention in message.content or mention_alt in message.content:
-        async with message.channel.typing():
-            content = message.content.replace(f"<@{client.user.id}>", "").strip()
-            ai_input = {'role': 'user', 'content': f"{content}. Keep answer under 1000 char!"}
-            response = await AsyncClient(host='http://ollama:11434').chat(model='deepseek-r1:1.5b', messages=[ai_input])
-            logging.info(response)
-            await message.reply(clean_response(response.message.content))
\ No newline at end of file
+        content = message.content.replace(mention, "").replace(mention_alt, "").strip()
+        history = conversation_history.get(message.channel.id)
+        key = normalize_prompt(content, history)
+        cached = response_cache.get(key)
+        if cached is not None:
+            conversation_history.add_exchange(message.channel.id, content, cached)
+            await message.reply(cached)
+            return
+        if key in _in_flight:
+            text, generation_seconds = await asyncio.shield(_in_flight[key])
+            response_cache.coalesced += 1
+            response_cache.saved_seconds += generation_seconds
+            conversation_history.add_exchange(message.channel.id, content, text)
+            await message.reply(text)
+            return
+        if _admitted >= AI_MAX_IN_FLIGHT + AI_MAX_QUEUED:
+            await message.reply("Mu aju on praegu täis, proovi natukese aja pärast uuesti!")
+            return
+
+        _admitted += 1
+        future = asyncio.get_running_loop().create_future()
+        _in_flight[key] = future
+        try:
+            async with message.channel.typing(), _generation_slots:
+                ai_input = {'role': 'user', 'content': f"{content}. Keep answer under 1000 char!"}
+                start = time.monotonic()
+                response = await stream_reply(message, history + [ai_input])
+                logging.info(response)
+                result = (clean_response(response) or '🤔', time.monotonic() - start)
+                response_cache.put(key, *result)
+                conversation_history.add_exchange(message.channel.id, content, result[0])
+                future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+            # Marks the exception as retrieved, there may be nobody else waiting for it
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            _admitted -= 1
+            del _in_flight[key]
+
+async def try_handle_ai_stats(message):
+    if message.content.startswith('$aistats'):
+        lookups = response_cache.hits + response_cache.misses
+        hit_rate = response_cache.hits / lookups if lookups else 0.0
+        await message.channel.send(
+            f"AI cache: {len(response_cache)}/{response_cache.max_size} vastust, {response_cache.hits} hit, "
+            f"{response_cache.misses} miss ({hit_rate:.0%}), {response_cache.coalesced} ühendatud, "
+            f"säästetud {response_cache.saved_seconds:.0f}s genereerimist, "
+            f"vestluse ajalugu {len(conversation_history)} kanalis")
@@ -1,11 +1,42 @@
 import discord
+import os
 from discord import app_commands, Message, Embed
 from discord.ext import commands
 import typing
 import sqlite3
+import asyncio
 import logging
 from datetime import datetime, timedelta
 import random
+import time
+import contextlib
+from dbthread import DbThread
+from collections import OrderedDict
+
+WITHDRAW_SQL = '''
+    UPDATE users
+    SET balance = balance - ?
+    WHERE user_id = ? AND balance >= ?
+    RETURNING balance
+'''
+
+WITHDRAW_LIMITLESS_SQL = '''
+    UPDATE users
+    SET balance = balance - ?
+    WHERE user_id = ?
+    RETURNING balance
+'''
+
+DEPOSIT_SQL = '''
+    UPDATE users
+    SET balance = balance + ?
+    WHERE user_id = ?
+    RETURNING balance
+'''
+
+LEADERBOARD_SIZE = 100
+LEADERBOARD_PAGE_SIZE = 10
+NAME_CACHE_TTL = 600
 
 FAILURE_MESSAGES = [
     "Su raha kadus nagu E36 karbid! ☀️💸",
@@ -38,12 +69,89 @@ FLEX_IMAGES = [
     "https://c.tenor.com/dfdxodtK4_YAAAAC/tenor.gif"
 ]
 
+class InsufficientFunds(Exception):
+    pass
+
+
+class Transaction:
+    """
+    Ledger operations collected on the event loop and applied by the bank worker as one SQL transaction.
+    If any withdraw would overdraw its account nothing is applied and committed stays False.
+    balances holds the resulting balances of every touched user either way.
+    """
+    def __init__(self):
+        self.ops = []
+        self.committed = False
+        self.balances = {}
+
+    def withdraw(self, user: discord.User | discord.Member, amount: int):
+        self.ops.append(('withdraw', user.id, amount))
+
+    def withdraw_limitless(self, user: discord.User | discord.Member, amount: int):
+        self.ops.append(('withdraw_limitless', user.id, amount))
+
+    def deposit(self, user: discord.User | discord.Member, amount: int):
+        self.ops.append(('deposit', user.id, amount))
+
+    def balance(self, user: discord.User | discord.Member) -> int:
+        return self.balances.get(user.id, 0)
+
+
+class BalanceCache:
+    """
+    LRU map of user id to committed balance. The bank's own mutations write their results through to it,
+    so entries never have to be invalidated.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._balances: OrderedDict[int, int] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._balances)
+
+    def get(self, user_id: int) -> int | None:
+        balance = self._balances.get(user_id)
+        if balance is None:
+            self.misses += 1
+            return None
+        self._balances.move_to_end(user_id)
+        self.hits += 1
+        return balance
+
+    def put(self, user_id: int, balance: int | None):
+        if balance is None:
+            self._balances.pop(user_id, None)
+            return
+        self._balances[user_id] = balance
+        self._balances.move_to_end(user_id)
+        if len(self._balances) > self.max_size:
+            self._balances.popitem(last=False)
+
+
 class BankCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.db_name = 'data/gambling.db'
-        self.conn = None
-        self._create_tables()
+        self.db = DbThread('data/gambling.db', 'bank-db', init=self._create_tables)
+        self.db.submit(self.db.get_connection).result()
+
+        # Group commit: when BANK_GROUP_COMMIT_MS is set, deposits and withdrawals are buffered as per-user deltas
+        # and written in one transaction every BANK_GROUP_COMMIT_MS milliseconds or BANK_GROUP_COMMIT_OPS operations
+        self.group_commit_ms = int(os.environ.get('BANK_GROUP_COMMIT_MS', '0'))
+        self.group_commit_ops = int(os.environ.get('BANK_GROUP_COMMIT_OPS', '100'))
+        self._pending: dict[int, int] = {}
+        self._pending_ops = 0
+        self._inflight: dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_wanted = asyncio.Event()
+        self._flush_now = asyncio.Event()
+        self._flush_task = None
+
+        # Worker results are delivered back to the loop in submission order, so writing them into the cache
+        # as they arrive never lets an older read overwrite a newer balance
+        self._cache = BalanceCache(int(os.environ.get('BANK_BALANCE_CACHE_SIZE', '1024')))
+        self._names: dict[int, tuple[str, float]] = {}
 
 
         self.ctx_menu = app_commands.ContextMenu(
@@ -52,8 +160,8 @@ class BankCog(commands.Cog):
         )
         self.bot.tree.add_command(self.ctx_menu)
 
-    def _create_tables(self):
-        with self._get_connection() as conn:
+    def _create_tables(self, conn):
+        with conn:
             conn.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -61,80 +169,227 @@ class BankCog(commands.Cog):
                     last_daily TEXT
                 )
             ''')
-            conn.commit()
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance DESC)')
+
+    async def cog_load(self):
+        if self.group_commit_ms:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def cog_unload(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+        await self.flush()
+        await self.db.close()
+
+    def _pending_delta(self, user_id: int) -> int:
+        return self._pending.get(user_id, 0) + self._inflight.get(user_id, 0)
+
+    def _buffer(self, user_id: int, delta: int):
+        self._pending[user_id] = self._pending.get(user_id, 0) + delta
+        self._pending_ops += 1
+        self._flush_wanted.set()
+        if self._pending_ops >= self.group_commit_ops:
+            self._flush_now.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._flush_wanted.wait()
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.group_commit_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wanted.clear()
+            self._flush_now.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            # In-flight deltas stay visible to readers until the worker has committed them
+            self._inflight, self._pending = self._pending, {}
+            self._pending_ops = 0
+            try:
+                balances = await self.db.run(self._apply_deltas, list(self._inflight.items()))
+                if balances is not None:
+                    for user_id, balance in balances.items():
+                        self._cache.put(user_id, balance)
+                else:
+                    for user_id, delta in self._inflight.items():
+                        self._pending[user_id] = self._pending.get(user_id, 0) + delta
+                        self._pending_ops += 1
+            finally:
+                self._inflight = {}
+
+    async def withdraw(self, user: discord.User | discord.Member, amount: int)->bool:
+        if self.group_commit_ms:
+            if await self.get_balance(user) < amount:
+                return False
+            self._buffer(user.id, -amount)
+            return True
+        balance = await self.db.run(self._withdraw, user.id, amount)
+        if balance is None:
+            return False
+        self._cache.put(user.id, balance)
+        return True
+
+    async def withdraw_limitless(self, user: discord.User | discord.Member, amount: int)->bool:
+        if self.group_commit_ms:
+            self._buffer(user.id, -amount)
+            return True
+        balance = await self.db.run(self._withdraw_limitless, user.id, amount)
+        self._cache.put(user.id, balance)
+        return balance is not None
+
+    async def deposit(self, user: discord.User | discord.Member, amount: int):
+        if self.group_commit_ms:
+            self._buffer(user.id, amount)
+            return
+        self._cache.put(user.id, await self.db.run(self._deposit, user.id, amount))
+
+    async def get_balance(self, user: discord.User | discord.Member)->int:
+        balance = self._cache.get(user.id)
+        if balance is None:
+            balance = await self.db.run(self._get_balance, user.id)
+            self._cache.put(user.id, balance)
+        return (balance or 0) + self._pending_delta(user.id)
+
+    async def get_balances(self, limit: int = -1, offset: int = 0)->list[tuple[int,int]]:
+        await self.flush()
+        return await self.db.run(self._get_balances, limit, offset)
+
+    async def update_daily(self, user: discord.User | discord.Member, amount: int) -> bool:
+        balance = await self.db.run(self._update_daily, user.id, amount)
+        if balance is None:
+            return False
+        self._cache.put(user.id, balance)
+        return True
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        tx = Transaction()
+        yield tx
+        # Buffered deltas have to land first so the overdraw checks see them
+        await self.flush()
+        await self.db.run(self._apply_transaction, tx)
+        for user_id in tx.balances:
+            self._cache.put(user_id, tx.balances[user_id])
+            tx.balances[user_id] += self._pending_delta(user_id)
+
+    async def transfer(self, from_user: discord.User | discord.Member, to_user: discord.User | discord.Member,
+                       amount: int) -> bool:
+        async with self.transaction() as tx:
+            tx.withdraw(from_user, amount)
+            tx.deposit(to_user, amount)
+        return tx.committed
 
-    def _get_connection(self):
-        if not self.conn:
-            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-        return self.conn
+    def _apply_transaction(self, tx: Transaction):
+        conn = self.db.get_connection()
+        try:
+            with conn:
+                cursor = conn.cursor()
+                for op, user_id, amount in tx.ops:
+                    if op == 'withdraw':
+                        cursor.execute(WITHDRAW_SQL, (amount, user_id, amount))
+                        if cursor.fetchone() is None:
+                            raise InsufficientFunds(user_id)
+                    elif op == 'withdraw_limitless':
+                        cursor.execute(WITHDRAW_LIMITLESS_SQL, (amount, user_id))
+                        cursor.fetchall()
+                    else:
+                        cursor.execute(DEPOSIT_SQL, (amount, user_id))
+                        cursor.fetchall()
+            tx.committed = True
+        except InsufficientFunds:
+            pass
+        except sqlite3.Error as e:
+            logging.error(f"Transaction failed: {e}")
 
-    def withdraw(self, user: discord.User | discord.Member, amount: int)->bool:
-        conn = self._get_connection()
+        user_ids = list({user_id for _, user_id, _ in tx.ops})
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET balance = balance - ? 
-                WHERE user_id = ? AND balance >= ?
-            ''', (amount, user.id, amount))
+            cursor.execute(f"SELECT user_id, balance FROM users WHERE user_id IN ({','.join('?' * len(user_ids))})",
+                           user_ids)
+            tx.balances = dict(cursor.fetchall())
+        except sqlite3.Error as e:
+            logging.error(f"Error reading transaction balances: {e}")
+
+    def _apply_deltas(self, deltas: list[tuple[int, int]]) -> dict[int, int] | None:
+        conn = self.db.get_connection()
+        try:
+            balances = {}
+            with conn:
+                cursor = conn.cursor()
+                for user_id, delta in deltas:
+                    cursor.execute(DEPOSIT_SQL, (delta, user_id))
+                    row = cursor.fetchone()
+                    if row is not None:
+                        balances[user_id] = row[0]
+            return balances
+        except sqlite3.Error as e:
+            logging.error(f"Group commit of {len(deltas)} balances failed: {e}")
+            return None
+
+    def _withdraw(self, user_id: int, amount: int)->int | None:
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(WITHDRAW_SQL, (amount, user_id, amount))
+            row = cursor.fetchone()
             conn.commit()
-            return cursor.rowcount > 0
+            return row[0] if row else None
         except sqlite3.Error as e:
             conn.rollback()
             logging.error(f"Failed to withdraw: {e}")
-            return False
+            return None
 
-    def withdraw_limitless(self, user: discord.User | discord.Member, amount: int):
-        conn = self._get_connection()
+    def _withdraw_limitless(self, user_id: int, amount: int)->int | None:
+        conn = self.db.get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET balance = balance - ? 
-                WHERE user_id = ?
-            ''', (amount, user.id))
+            cursor.execute(WITHDRAW_LIMITLESS_SQL, (amount, user_id))
+            row = cursor.fetchone()
             conn.commit()
-            return cursor.rowcount > 0
+            return row[0] if row else None
         except sqlite3.Error as e:
             conn.rollback()
             logging.error(f"Failed to withdraw: {e}")
-            return False
+            return None
 
-    def deposit(self, user: discord.User | discord.Member, amount: int):
-        conn = self._get_connection()
+    def _deposit(self, user_id: int, amount: int)->int | None:
+        conn = self.db.get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET balance = balance + ? 
-                WHERE user_id = ?
-            ''', (amount, user.id))
+            cursor.execute(DEPOSIT_SQL, (amount, user_id))
+            row = cursor.fetchone()
             conn.commit()
+            return row[0] if row else None
         except sqlite3.Error as e:
-            logging.error(f"Failed to deposit {user.id}: {e}")
+            logging.error(f"Failed to deposit {user_id}: {e}")
+            return None
 
-    def get_balance(self, user: discord.User | discord.Member)->int:
-        conn = self._get_connection()
+    def _get_balance(self, user_id: int)->int | None:
+        conn = self.db.get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user.id,))
-            result = cursor.fetchone()[0]
+            cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
 
-            if not result:
-                cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user.id,))
+            if result is None:
+                cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
                 conn.commit()
                 return 0
 
-            return result
+            return result[0]
         except sqlite3.Error as e:
-            logging.error(f"Error getting user {user.id}: {e}")
-            return 0
+            logging.error(f"Error getting user {user_id}: {e}")
+            return None
         
-    def get_balances(self)->list[tuple[int,int]]:
-        conn = self._get_connection()
+    def _get_balances(self, limit: int, offset: int)->list[tuple[int,int]]:
+        conn = self.db.get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute("SELECT user_id,balance FROM users ORDER BY balance DESC")
+            cursor.execute("SELECT user_id,balance FROM users ORDER BY balance DESC LIMIT ? OFFSET ?", (limit, offset))
             result = cursor.fetchall()
 
             return result
@@ -142,16 +397,16 @@ class BankCog(commands.Cog):
             logging.error(f"Error : {e}")
             return []
     
-    def update_daily(self, user: discord.User | discord.Member, amount: int) -> bool:
-        conn = self._get_connection()
+    def _update_daily(self, user_id: int, amount: int) -> int | None:
+        conn = self.db.get_connection()
         try:
             now = datetime.now()
             cursor = conn.cursor()
-            cursor.execute("SELECT last_daily FROM users WHERE user_id = ?", (user.id,))
-            last_daily = datetime.fromisoformat(cursor.fetchone()[0])
-            diff = now.date() - last_daily.date()
-            if diff < timedelta(days=1):
-                return False
+            cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+            cursor.execute("SELECT last_daily FROM users WHERE user_id = ?", (user_id,))
+            last_daily = cursor.fetchone()[0]
+            if last_daily is not None and now.date() - datetime.fromisoformat(last_daily).date() < timedelta(days=1):
+                return None
             
             cursor = conn.cursor()
             cursor.execute('''
@@ -159,39 +414,41 @@ class BankCog(commands.Cog):
                 SET balance = balance + ?, 
                     last_daily = ? 
                 WHERE user_id = ?
-            ''', (amount, now.isoformat(), user.id))
+                RETURNING balance
+            ''', (amount, now.isoformat(), user_id))
+            balance = cursor.fetchone()[0]
             conn.commit()
-            return True
+            return balance
         except sqlite3.Error as e:
-            logging.error(f"Daily update failed for {user.id}: {e}")
-            return False
+            logging.error(f"Daily update failed for {user_id}: {e}")
+            return None
     
     async def _get_balance_ctxmenu(self, interaction: discord.Interaction, member: discord.Member):
-        balance = self.get_balance(member)
+        balance = await self.get_balance(member)
         await interaction.response.send_message(content=f'{member} omab {balance} eurot.')
 
     @app_commands.command(name="balance")
     async def _get_balance_cmd(self, interaction: discord.Interaction, member: typing.Optional[discord.Member]=None):
         user = interaction.user if member is None else member
-        balance = self.get_balance(user)
+        balance = await self.get_balance(user)
         await interaction.response.send_message(content=f'{user} omab {balance} eurot.')
     
     @app_commands.command(name="flex")
     async def _flex_cmd(self, interaction: discord.Interaction):
-        balance = self.get_balance(interaction.user)
+        balance = await self.get_balance(interaction.user)
 
         if balance < 250:
             await interaction.response.send_message(content="Kus su raha on!? 💸")
             return
 
-        if not self.withdraw(interaction.user, 250):
+        if not await self.withdraw(interaction.user, 250):
             await interaction.response.send_message(content="❌ Tekkis viga raha mahaarvamisel.")
             return
 
         chance = random.random()
         if chance < 0.2:
             if random.random() < 0.1:
-                self.withdraw(interaction.user, balance-250)
+                await self.withdraw(interaction.user, balance-250)
                 await interaction.response.send_message(content=random.choice(BIG_FAILURE_MESSAGES))
             else:
                 await interaction.response.send_message(content=random.choice(FAILURE_MESSAGES))
@@ -207,10 +464,10 @@ class BankCog(commands.Cog):
     async def _daily_cmd(self, interaction: discord.Interaction):
         DAILY_BONUS = 1000
 
-        success = self.update_daily(interaction.user, DAILY_BONUS)
+        success = await self.update_daily(interaction.user, DAILY_BONUS)
         
         if success:
-            balance = self.get_balance(interaction.user)
+            balance = await self.get_balance(interaction.user)
             await interaction.response.send_message(content=f"Said oma {DAILY_BONUS} eurot! Su uus balanss on {balance} eurot.")
             return
 
@@ -218,7 +475,7 @@ class BankCog(commands.Cog):
 
     @app_commands.command(name="beg")
     async def _beg_scmd(self, interaction: discord.Interaction):
-        self.deposit(interaction.user, 5)
+        await self.deposit(interaction.user, 5)
         await interaction.response.send_message(content="Su YT ad revenue tõi sulle 5€ sisse!")
  
     @commands.command(name="beg")
@@ -226,31 +483,97 @@ class BankCog(commands.Cog):
         chance = random.random()
         if chance < 0.5:
             if random.random() < 0.25:
-                balance = self.get_balance(ctx.author)
+                balance = await self.get_balance(ctx.author)
                 if balance > 0:
-                    self.withdraw(ctx.author, balance)
+                    await self.withdraw(ctx.author, balance)
                     await ctx.send("Kerjasid mustlaselt ja ta lasi kogu su raha rotti!")
                 else:
-                    self.deposit(ctx.author, 200)
+                    await self.deposit(ctx.author, 200)
                     await ctx.send("Said Petsilt korraliku nutsu, lase edasi tšempion!")
             else:
-                self.deposit(ctx.author, 10)
+                await self.deposit(ctx.author, 10)
                 await ctx.send("Okei kerjus... saad oma 10 eurot, mine osta Bocki!")
     
-    async def _get_user_name_by_id(self, guild: discord.Guild, id: int):
-        member = guild.get_member(id)
-        if member is None:
-            member = await guild.fetch_member(id)
-        if member is None:
-            return f"Unknown({id})"
-        return member.display_name
+    @commands.command(name="bankstats")
+    async def _bankstats_rcmd(self, ctx: commands.Context):
+        lookups = self._cache.hits + self._cache.misses
+        hit_rate = self._cache.hits / lookups if lookups else 0.0
+        await ctx.send(f"Saldo cache: {len(self._cache)}/{self._cache.max_size} kasutajat, "
+                       f"{self._cache.hits} hit, {self._cache.misses} miss ({hit_rate:.0%})")
+
+    async def _get_user_names(self, guild: discord.Guild, ids: list[int]) -> dict[int, str]:
+        now = time.monotonic()
+        names = {}
+        missing = []
+        for id in ids:
+            cached = self._names.get(id)
+            if cached and cached[1] > now:
+                names[id] = cached[0]
+                continue
+            member = guild.get_member(id)
+            if member is None:
+                missing.append(id)
+            else:
+                names[id] = member.display_name
+
+        if missing:
+            # One gateway member chunk request instead of a REST fetch_member per user
+            try:
+                members = await guild.query_members(user_ids=missing[:100], limit=100)
+            except (discord.ClientException, asyncio.TimeoutError) as e:
+                logging.error(f"Failed to query leaderboard members: {e}")
+                members = []
+            for member in members:
+                names[member.id] = member.display_name
+
+        for id in ids:
+            name = names.setdefault(id, f"Unknown({id})")
+            self._names[id] = (name, now + NAME_CACHE_TTL)
+        return names
+
+    async def _leaderboard_page(self, guild: discord.Guild, ranking: list[tuple[int, int]], page: int) -> str:
+        if not ranking:
+            return "Keegi pole veel mänginud."
+        start = page * LEADERBOARD_PAGE_SIZE
+        rows = ranking[start:start + LEADERBOARD_PAGE_SIZE]
+        names = await self._get_user_names(guild, [user_id for user_id, _ in rows])
+        return "\n".join(f"{start + i + 1}. {balance} {names[user_id]}" for i, (user_id, balance) in enumerate(rows))
 
     @app_commands.command(name="leaderboard")
     async def _leaderboard_scmd(self, interaction: discord.Interaction):
-        balances = self.get_balances()
-        content = "\n".join([f"{i}. {balances[i][1]} {await self._get_user_name_by_id(interaction.guild,balances[i][0])}" for i in range(len(balances))])
-        await interaction.response.send_message(content=content)
-    
+        await interaction.response.defer()
+        ranking = await self.get_balances(LEADERBOARD_SIZE)
+        view = LeaderboardView(self, interaction.guild, ranking)
+        content = await self._leaderboard_page(interaction.guild, ranking, 0)
+        await interaction.followup.send(content=content, view=view)
+
+
+class LeaderboardView(discord.ui.View):
+    def __init__(self, bank: BankCog, guild: discord.Guild, ranking: list[tuple[int, int]]):
+        super().__init__(timeout=120)
+        self.bank = bank
+        self.guild = guild
+        self.ranking = ranking
+        self.page = 0
+        self.pages = max(1, -(-len(ranking) // LEADERBOARD_PAGE_SIZE))
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        self.page = page % self.pages
+        await interaction.response.defer()
+        content = await self.bank._leaderboard_page(self.guild, self.ranking, self.page)
+        await interaction.edit_original_response(content=content, view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.gray)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.gray)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        self.clear_items()
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(BankCog(bot))
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""
+Measures how long the event loop stalls while 1000 bets hit the bank at once.
+
+    python benchmarks/bank_loop_lag.py [checkout]
+
+checkout defaults to this repository. To compare with an older revision, check it out next to it first, e.g.
+git worktree add /tmp/bank-before <revision>. Each bet withdraws the stake and deposits the winnings of every second
+one, as a ledger transaction where the bank has them. A ticker task wakes every millisecond and records how late it
+was woken, which is how long a gateway event would have waited.
+"""
+import asyncio
+import inspect
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+CHECKOUT = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..'))
+BETS = 1000
+USERS = 100
+STAKE = 10
+TICK = 0.001
+
+sys.path.insert(0, CHECKOUT)
+import bank  # noqa: E402
+
+
+async def call(result):
+    # Before the bank moved to its worker thread its methods were synchronous
+    return await result if inspect.isawaitable(result) else result
+
+
+async def bet(cog, user, win):
+    if hasattr(cog, 'transaction'):
+        async with cog.transaction() as tx:
+            tx.withdraw(user, STAKE)
+            if win:
+                tx.deposit(user, 2 * STAKE)
+        return
+    if await call(cog.withdraw(user, STAKE)) and win:
+        await call(cog.deposit(user, 2 * STAKE))
+
+
+async def ticker(stalls):
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(TICK)
+        now = time.perf_counter()
+        stalls.append(now - last - TICK)
+        last = now
+
+
+async def main():
+    cog = bank.BankCog(SimpleNamespace(tree=SimpleNamespace(add_command=lambda command: None)))
+    with sqlite3.connect('data/gambling.db') as conn:
+        conn.executemany('INSERT OR REPLACE INTO users (user_id, balance) VALUES (?, ?)',
+                         [(user_id, BETS * STAKE) for user_id in range(USERS)])
+    conn.close()
+    users = [SimpleNamespace(id=user_id) for user_id in range(USERS)]
+
+    stalls = []
+    ticker_task = asyncio.create_task(ticker(stalls))
+    await asyncio.sleep(0.05)
+    stalls.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(bet(cog, random.choice(users), i % 2 == 0) for i in range(BETS)))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.01)
+    ticker_task.cancel()
+
+    stalls.sort()
+    print(f"{CHECKOUT}: {BETS} bets in {elapsed * 1000:.0f} ms, loop stall worst {stalls[-1] * 1000:.1f} ms, "
+          f"median {stalls[len(stalls) // 2] * 1000:.1f} ms over {len(stalls)} ticks")
+
+
+if __name__ == '__main__':
+    # On the checkout's disk, /tmp may be a tmpfs where commits cost nothing
+    with tempfile.TemporaryDirectory(dir=CHECKOUT) as workdir:
+        os.chdir(workdir)
+        os.mkdir('data')
+        asyncio.run(main())
@@ -48,22 +48,23 @@ class BlackjackView(discord.ui.View):
             f"**Diileri kaardid:** {' '.join(self.dealer_hand)} (kokku: {d_score})"
         )
         if self.game_over:
-            if p_score > 21:
-                content += f"\n💦 Bust! 💸 Kaotasid {self.bet} eurot!"
-                self.bank.deposit(self.bot.user, self.bet*2)
-            elif d_score > 21:
-                content += f"\n💦 Diiler bustis! Sa võitsid {self.bet} eurot!"
-                self.bank.deposit(self.player, self.bet*2)
-            elif d_score < p_score:
-                content += f"\n🎉 Sa võitsid {self.bet} eurot!"
-                self.bank.deposit(self.player, self.bet*2)
-            elif d_score > p_score:
-                content += f"\n💸 Kaotasid {self.bet} eurot. Diiler võitis!"
-                self.bank.deposit(self.bot.user, self.bet*2)
-            else:
-                content += "\n🤝 Viik! Sa said panuse tagasi."
-                self.bank.deposit(self.player, self.bet)
-                self.bank.deposit(self.bot.user, self.bet)
+            async with self.bank.transaction() as tx:
+                if p_score > 21:
+                    content += f"\n💦 Bust! 💸 Kaotasid {self.bet} eurot!"
+                    tx.deposit(self.bot.user, self.bet*2)
+                elif d_score > 21:
+                    content += f"\n💦 Diiler bustis! Sa võitsid {self.bet} eurot!"
+                    tx.deposit(self.player, self.bet*2)
+                elif d_score < p_score:
+                    content += f"\n🎉 Sa võitsid {self.bet} eurot!"
+                    tx.deposit(self.player, self.bet*2)
+                elif d_score > p_score:
+                    content += f"\n💸 Kaotasid {self.bet} eurot. Diiler võitis!"
+                    tx.deposit(self.bot.user, self.bet*2)
+                else:
+                    content += "\n🤝 Viik! Sa said panuse tagasi."
+                    tx.deposit(self.player, self.bet)
+                    tx.deposit(self.bot.user, self.bet)
             
             for child in self.children:
                 child.disabled = True
@@ -110,13 +111,13 @@ class BlackjackCog(commands.Cog):
             await interaction.response.send_message(content="Nii väikese panusega sind mängu ei võeta!")
             return
         
-        balance = bank.get_balance(interaction.user)
-        if bet > balance:
-            await interaction.response.send_message(content=f"Jää oma võimekuse piiridesse! (max panus sulle: {balance})")
-            return
+        async with bank.transaction() as tx:
+            tx.withdraw(interaction.user, bet)
+            tx.withdraw_limitless(self.bot.user, bet)
 
-        bank.withdraw(interaction.user, bet)
-        bank.withdraw_limitless(self.bot.user, bet)
+        if not tx.committed:
+            await interaction.response.send_message(content=f"Jää oma võimekuse piiridesse! (max panus sulle: {tx.balance(interaction.user)})")
+            return
 
         deck = create_deck()
         player_hand = [deck.pop(), deck.pop()]
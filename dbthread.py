@@ -0,0 +1,42 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DbThread:
+    """
+    A SQLite connection owned by a single worker thread. All queries go through that thread, so they are
+    serialized and never block the event loop. init(conn) runs once, when the connection is opened.
+    """
+    def __init__(self, db_name, thread_name_prefix, init=None):
+        self.db_name = db_name
+        self.init = init
+        self.conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name_prefix)
+
+    def get_connection(self):
+        """
+        Returns the connection, only call it from functions running on the thread.
+        """
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            if self.init:
+                self.init(self.conn)
+        return self.conn
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _close_connection(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def close(self):
+        await self.run(self._close_connection)
+        self._executor.shutdown()
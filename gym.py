@@ -1,9 +1,81 @@
 from datetime import datetime, timedelta
-import requests
+import os
+import time
+import asyncio
+import aiohttp
 import pytz
 import logging
+from dbthread import DbThread
+from discord.ext import tasks
 
-PROMETHEUS_URL = 'http://prometheus:9090'
+PROMETHEUS_URL = os.environ.get('PROMETHEUS_URL', 'http://prometheus:9090')
+PROMETHEUS_TIMEOUT = float(os.environ.get('PROMETHEUS_TIMEOUT', '5'))
+
+CACHE_DB = 'data/gym_cache.db'
+
+_session = None
+
+
+def get_session():
+    """
+    Returns the shared Prometheus HTTP session, its connection pool is reused by all the queries.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            base_url=PROMETHEUS_URL,
+            timeout=aiohttp.ClientTimeout(total=PROMETHEUS_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=8),
+        )
+    return _session
+
+
+def _create_tables(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS daily_max (date TEXT PRIMARY KEY, count INTEGER)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS slot_counts (
+        date TEXT,
+        slot INTEGER,
+        count INTEGER,
+        PRIMARY KEY (date, slot)
+    )''')
+    conn.commit()
+
+
+# Past occupancy never changes, so it is cached forever
+cache_db = DbThread(CACHE_DB, 'gym-cache', init=_create_tables)
+
+
+def _get_cached_daily_max(date):
+    row = cache_db.get_connection().execute('SELECT count FROM daily_max WHERE date = ?', (date,)).fetchone()
+    return row and row[0]
+
+
+def _put_cached_daily_max(date, count):
+    with cache_db.get_connection() as conn:
+        conn.execute('INSERT OR REPLACE INTO daily_max (date, count) VALUES (?, ?)', (date, count))
+
+
+def _get_cached_slot_count(date, slot):
+    row = cache_db.get_connection().execute('SELECT count FROM slot_counts WHERE date = ? AND slot = ?',
+                                            (date, slot)).fetchone()
+    return row and row[0]
+
+
+def _put_cached_slot_count(date, slot, count):
+    with cache_db.get_connection() as conn:
+        conn.execute('INSERT OR REPLACE INTO slot_counts (date, slot, count) VALUES (?, ?, ?)', (date, slot, count))
+
+
+def get_slot_key(dt):
+    # Keyed in UTC, so the same quarter-hour gets the same key whichever timezone asked for it
+    utc = dt.astimezone(pytz.utc)
+    return utc.strftime('%Y-%m-%d'), utc.hour * 4 + utc.minute // 15
+
+
+async def query_prometheus(params):
+    async with get_session().get('/api/v1/query', params=params) as response:
+        response.raise_for_status()
+        return await response.json()
 
 
 def round_time_to_nearest_quarter_hour(dt=None):
@@ -30,28 +102,43 @@ def get_same_weekday_dates(current_date, weeks_back=2):
     return dates
 
 
-def get_max_people_count_for_day(date):
+def get_midnight(day, tz):
+    midnight = datetime.combine(day, datetime.min.time())
+    if hasattr(tz, 'localize'):
+        return tz.localize(midnight)
+    return midnight.replace(tzinfo=tz)
+
+
+def get_day_bounds(date):
+    """
+    Returns the timestamps of the midnights starting and ending date's day in its own timezone. A naive date is
+    taken as the local time of the host.
+    """
+    start = get_midnight(date.date(), date.tzinfo)
+    end = get_midnight(date.date() + timedelta(days=1), date.tzinfo)
+    return start.timestamp(), end.timestamp()
+
+
+# Returns None when Prometheus has no answer, so that a failure doesn't get cached as 0
+async def fetch_max_people_count_for_day(date):
     try:
-        start_time = datetime.combine(date, datetime.min.time()).timestamp()
-        end_time = datetime.combine(date + timedelta(days=1), datetime.min.time()).timestamp()
-        query = 'sum(max_over_time(people_count[1d]))'
+        # Evaluated at the day's closing midnight over the day's length, which is not 24h on DST changes
+        start, end = get_day_bounds(date)
+        query = f'sum(max_over_time(people_count[{int(end - start)}s]))'
         params = {
             'query': query,
-            'start': start_time,
-            'end': end_time,
-            'step': '1d',
+            'time': end,
         }
-        response = requests.get(f'{PROMETHEUS_URL}/api/v1/query', params=params)
-        data = response.json()
+        data = await query_prometheus(params)
         if data['status'] == 'success' and len(data['data']['result']) == 1:
             return int(data['data']['result'][0]['value'][1])
-        return 0
+        return None
     except Exception as e:
         logging.error(f"Error fetching data for date {date}: {e}")
-        return 0
+        return None
 
 
-def get_average_people_count_at_time(time):
+async def fetch_average_people_count_at_time(time):
     try:
         timestamp = time.timestamp()
         query = 'sum(people_count)'
@@ -59,8 +146,7 @@ def get_average_people_count_at_time(time):
             'query': query,
             'time': timestamp,
         }
-        response = requests.get(f'{PROMETHEUS_URL}/api/v1/query', params=params)
-        data = response.json()
+        data = await query_prometheus(params)
 
         if data['status'] == 'success' and len(data['data']['result']) == 1:
             cnt = int(data['data']['result'][0]['value'][1])
@@ -70,10 +156,57 @@ def get_average_people_count_at_time(time):
             return cnt
         logging.debug(params)
         logging.debug(data)
-        return 0
+        return None
     except Exception as e:
         logging.error(f"Error fetching average people count at time {time}: {e}")
+        return None
+
+
+async def get_max_people_count_for_day(date):
+    end = get_day_bounds(date)[1]
+    key = datetime.fromtimestamp(end, pytz.utc).isoformat()
+    count = await cache_db.run(_get_cached_daily_max, key)
+    if count is not None:
+        return count
+
+    count = await fetch_max_people_count_for_day(date)
+    if count is None:
         return 0
+    if end <= time.time():
+        await cache_db.run(_put_cached_daily_max, key, count)
+    return count
+
+
+async def get_average_people_count_at_time(dt):
+    key = get_slot_key(dt)
+    count = await cache_db.run(_get_cached_slot_count, *key)
+    if count is not None:
+        return count
+
+    count = await fetch_average_people_count_at_time(dt)
+    if count is None:
+        return 0
+    if dt.timestamp() <= time.time():
+        await cache_db.run(_put_cached_slot_count, *key, count)
+    return count
+
+
+async def get_occupancy_history(current_time):
+    dates = get_same_weekday_dates(current_time)
+    # All the lookups run at once, so the reply waits only for the slowest query
+    return await asyncio.gather(
+        asyncio.gather(*(get_max_people_count_for_day(date) for date in dates)),
+        asyncio.gather(*(get_average_people_count_at_time(date) for date in dates)),
+    )
+
+
+# Fills the cache for the next quarter-hour ahead of time, so that "mhm" usually needs no Prometheus queries at all
+@tasks.loop(minutes=15.0)
+async def warm_occupancy_cache():
+    try:
+        await get_occupancy_history(round_time_to_nearest_quarter_hour() + timedelta(minutes=15))
+    except Exception as e:
+        logging.error(f"Error warming gym occupancy cache: {e}")
 
 
 async def try_handle_mhm(message):
@@ -86,15 +219,7 @@ async def try_handle_mhm(message):
         sydney_time = datetime.now(sydney_timezone)
         current_time = round_time_to_nearest_quarter_hour(sydney_time)
 
-    dates = get_same_weekday_dates(current_time)
-
-    current_counts = []
-    daily_maxima = []
-    for date in dates:
-        max_count = get_max_people_count_for_day(date)
-        daily_maxima.append(max_count)
-        current_count = get_average_people_count_at_time(date)
-        current_counts.append(current_count)
+    daily_maxima, current_counts = await get_occupancy_history(current_time)
 
     average_daily_max = sum(daily_maxima) / len(daily_maxima)
     average_daily_current = sum(current_counts) / len(current_counts)
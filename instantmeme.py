@@ -6,57 +6,440 @@ import numpy as np
 import mediapipe as mp
 from mediapipe.python.solutions.drawing_utils import _normalized_to_pixel_coordinates
 import io
+import json
+import time
+import hashlib
+import queue
+import asyncio
 import logging
+import contextlib
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 OVERLAYS_FOLDER = 'data/faces'
+OVERLAY_INDEX_FILE = 'data/faces_index.json'
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg']
+# Models per configuration in each image worker, which handles one image at a time
+FACE_MESH_POOL_SIZE = int(os.environ.get('FACE_MESH_POOL_SIZE', '1'))
+DETECT_MAX_SIDE = int(os.environ.get('INSTANTMEME_DETECT_MAX_SIDE', '1280'))
+NO_FACES = np.empty((0, 478, 3))
+LANDMARK_COLOR = (0, 0, 255)
+FACE_LETTERS = {
+    33: 'l',
+    159: 't',
+    133: 'r',
+    145: 'b',
+    362: 'L',
+    386: 'T',
+    263: 'R',
+    374: 'B',
+    61: 'm',  # may be wrong
+    409: 'M',  # wrong but close
+}
+IMAGE_WORKERS = int(os.environ.get('INSTANTMEME_WORKERS', '2'))
+MAX_PENDING_IMAGES = int(os.environ.get('INSTANTMEME_MAX_PENDING', '8'))
+CACHE_FOLDER = os.environ.get('INSTANTMEME_CACHE_DIR', 'data/cache/instantmeme')
+CACHE_MAX_BYTES = int(os.environ.get('INSTANTMEME_CACHE_MAX_MB', '256')) * 1024 * 1024
+OUTPUT_FORMAT = os.environ.get('INSTANTMEME_OUTPUT_FORMAT', 'auto')  # auto, png, jpeg or webp
+OUTPUT_QUALITY = int(os.environ.get('INSTANTMEME_OUTPUT_QUALITY', '90'))
+OUTPUT_MAX_SIDE = int(os.environ.get('INSTANTMEME_OUTPUT_MAX_SIDE', '0'))
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Every mode except the random overlays always renders the same output for the same image
+DETERMINISTIC_MODES = {'mask', 'eyes', 'explainmin', 'explainfull'}
+
+
+class ModelPool:
+    """
+    Pre-warmed mediapipe models of one configuration. Each instance is checked out by one caller at a time.
+    """
+    def __init__(self, factory, size=FACE_MESH_POOL_SIZE):
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(factory())
+
+    @contextlib.contextmanager
+    def checkout(self):
+        model = self._idle.get()
+        try:
+            yield model
+        finally:
+            self._idle.put(model)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+model_pools = {}
+
+
+def create_face_mesh(max_num_faces):
+    return mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=True,
+        max_num_faces=max_num_faces,
+        refine_landmarks=True,
+        min_detection_confidence=0.5)
+
+
+def create_face_detection():
+    # Same short-range detector FaceMesh runs internally, so it never rejects an image FaceMesh would accept
+    return mp.solutions.face_detection.FaceDetection(model_selection=0, min_detection_confidence=0.5)
+
+
+def get_model_pool(name, factory):
+    if name not in model_pools:
+        model_pools[name] = ModelPool(factory)
+    return model_pools[name]
+
+
+class ResultCache:
+    """
+    Size-bounded on-disk LRU of per-image results, keyed by the SHA-256 of the attachment bytes.
+    Landmarks are shared by all modes, encoded outputs are only stored for deterministic modes.
+    Recency is tracked through file mtimes, so all image workers can share one folder.
+    """
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def _read(self, name):
+        path = os.path.join(self.folder, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write(self, name, data):
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently used files until there is some headroom again
+        for _, size, path in sorted(entries):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+            if total <= self.max_bytes * 0.9:
+                break
+
+    def get_landmarks(self, key):
+        data = self._read(f"{key}.landmarks.npy")
+        return None if data is None else np.load(io.BytesIO(data))
+
+    def put_landmarks(self, key, landmarks):
+        buffer = io.BytesIO()
+        np.save(buffer, landmarks)
+        self._write(f"{key}.landmarks.npy", buffer.getvalue())
+
+    # Outputs depend on the encoder settings too, so changing them doesn't serve stale encodings
+    def get_output(self, key, mode):
+        return self._read(f"{key}.{mode}.{OUTPUT_FORMAT}{OUTPUT_QUALITY}-{OUTPUT_MAX_SIDE}.out")
+
+    def put_output(self, key, mode, output_bytes):
+        self._write(f"{key}.{mode}.{OUTPUT_FORMAT}{OUTPUT_QUALITY}-{OUTPUT_MAX_SIDE}.out", output_bytes)
+
+
+class Overlay:
+    def __init__(self, name, image, brightness, contrast, eyes, flipped_eyes):
+        self.name = name
+        self.image = image
+        self.flipped = cv2.flip(image, 1)
+        self.stats = (brightness, contrast)
+        self.eyes = eyes
+        self.flipped_eyes = flipped_eyes
+
+
+class OverlayIndex:
+    """
+    Decoded overlay faces with their flipped variants, brightness/contrast and eye coordinates.
+    The index is rebuilt when the overlay folder changes. Stats and eye coordinates are persisted to
+    OVERLAY_INDEX_FILE, so face detection only runs for overlays that are new or modified.
+    """
+    def __init__(self, folder=OVERLAYS_FOLDER, index_file=OVERLAY_INDEX_FILE):
+        self.folder = folder
+        self.index_file = index_file
+        self.overlays = []
+        self._folder_mtime = None
+
+    @property
+    def built(self):
+        return self._folder_mtime is not None
+
+    def get_overlays(self, detect=True):
+        try:
+            folder_mtime = os.stat(self.folder).st_mtime_ns
+        except FileNotFoundError:
+            logging.error(f"Overlay folder {self.folder} does not exist")
+            return []
+        # Without detection, overlays missing from the persisted index are left out and the index stays unbuilt
+        if folder_mtime != self._folder_mtime and self._build(detect):
+            self._folder_mtime = folder_mtime
+        return self.overlays
+
+    def _load(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, index):
+        # Image workers rebuild the index on their own when the folder changes, so each writes its own temp file
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def _describe(image, stat):
+        brightness = calculate_average_brightness(image)
+        contrast = calculate_average_contrast(image)
+        return {
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'brightness': float(brightness),
+            'contrast': float(contrast),
+            'eyes': get_overlay_eyes(image),
+            'flipped_eyes': get_overlay_eyes(cv2.flip(image, 1)),
+        }
+
+    def _build(self, detect=True):
+        persisted = self._load()
+        index = {}
+        overlays = []
+        complete = True
+        for filename in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, filename)
+            image = get_img_from_path(path)
+            if image is None:
+                continue
+            if image.shape[2] == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+
+            stat = os.stat(path)
+            meta = persisted.get(filename)
+            if meta is None or meta['mtime'] != stat.st_mtime_ns or meta['size'] != stat.st_size:
+                if not detect:
+                    complete = False
+                    continue
+                meta = self._describe(image, stat)
+            index[filename] = meta
+
+            if meta['eyes'] is None or meta['flipped_eyes'] is None:
+                logging.warning(f"No face found on overlay {filename}, skipping it")
+                continue
+            overlays.append(Overlay(filename, image, meta['brightness'], meta['contrast'],
+                                    meta['eyes'], meta['flipped_eyes']))
+
+        if not complete:
+            return False
+        if index != persisted:
+            self._save(index)
+        logging.info(f"Indexed {len(overlays)} overlays from {self.folder}")
+        self.overlays = overlays
+        return True
+
+
+_executor = None
+_executor_lock = asyncio.Lock()
+_pending_images = 0
+
+
+def init_worker():
+    get_model_pool('face_detection', create_face_detection)
+    # Photos are searched for up to 10 faces, overlays for exactly one
+    for no_of_faces in (10, 1):
+        get_model_pool(f'face_mesh_{no_of_faces}', lambda: create_face_mesh(no_of_faces))
+    overlay_index.get_overlays()
+
+
+async def build_overlay_index():
+    """
+    Builds and persists the overlay index once before the image workers start, so that they inherit it instead of
+    all detecting the same overlays at once. Detection runs in a short-lived process of its own because mediapipe's
+    threads don't survive forking, this process only loads the result. If that fails the workers build it themselves.
+    The event loop only forks the process, waiting for it and loading the result run in threads.
+    """
+    if overlay_index.built:
+        return
+    # Forked from the loop's thread, a child forked from an executor thread fails at exit joining that same thread
+    process = multiprocessing.Process(target=overlay_index.get_overlays)
+    process.start()
+    await asyncio.to_thread(process.join)
+    if process.exitcode == 0:
+        await asyncio.to_thread(overlay_index.get_overlays, False)
+
+
+def _ping():
+    return True
+
+
+async def get_executor():
+    global _executor
+    async with _executor_lock:
+        if _executor is None:
+            # On a cold start detection takes a while, the first image waits for it
+            await build_overlay_index()
+            _executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, initializer=init_worker)
+    return _executor
+
+
+async def start_image_workers():
+    (await get_executor()).submit(_ping)
+
+
+def get_mode(content):
+    for mode in ('$mask', '$eyes', '$explainmin', '$explainfull'):
+        if content.startswith(mode):
+            return mode[1:]
+    return 'overlay'
+
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def process_image(img_bytes, mode):
+    """
+    Runs the whole meme pipeline in an image worker process.
+    Returns the encoded output (None when there are no faces) and per-stage timings in milliseconds.
+    """
+    timings = {}
+    key = hashlib.sha256(img_bytes).hexdigest()
+    if mode in DETERMINISTIC_MODES:
+        output_bytes = result_cache.get_output(key, mode)
+        if output_bytes is not None:
+            timings['cache'] = 'output'
+            return output_bytes, timings
+
+    faces = result_cache.get_landmarks(key)
+    timings['cache'] = 'miss' if faces is None else 'landmarks'
+    if faces is not None and not len(faces):
+        return None, timings
+
+    start = time.perf_counter()
+    img = decode_img(img_bytes)
+    timings['decode_ms'] = _elapsed_ms(start)
+    if img is None:
+        return None, timings
+
+    if faces is None:
+        start = time.perf_counter()
+        faces = get_faces(img)
+        timings['detect_ms'] = _elapsed_ms(start)
+        result_cache.put_landmarks(key, faces)
+        if not len(faces):
+            return None, timings
+
+    start = time.perf_counter()
+    if mode == 'mask':
+        draw_masks_on_faces(img, faces)
+    elif mode == 'eyes':
+        draw_specific_points_on_faces(img, faces)
+    elif mode == 'explainmin':
+        draw_letters_on_faces(img, faces, '')
+    elif mode == 'explainfull':
+        draw_letters_on_faces(img, faces)
+    else:
+        draw_overlays_on_faces(img, faces)
+    timings['draw_ms'] = _elapsed_ms(start)
+
+    start = time.perf_counter()
+    output_bytes = encode_img(img, get_output_format(img, img_bytes, mode), sharp=mode != 'overlay')
+    timings['encode_ms'] = _elapsed_ms(start)
+    if mode in DETERMINISTIC_MODES:
+        result_cache.put_output(key, mode, output_bytes)
+    return output_bytes, timings
 
 
 async def try_handle_instant_meme(message):
+    global _executor, _pending_images
     if message.content.startswith('$ignore'):
         return;
     if message.attachments:
         for attachment in message.attachments:
-            if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg']):
+            if any(attachment.filename.lower().endswith(ext) for ext in IMAGE_EXTENSIONS):
                 logging.debug('try_handle_instant_meme',
                               extra={'message_content': message.content, 'message_id': message.id})
-                async with message.channel.typing():
-                    img = await get_img_from_attachment(attachment)
-                    faces = get_faces(img)
-
-                    if not faces.multi_face_landmarks:
-                        logging.info('Message {message_id} didnt contain any faces', message_id=message.id)
-                        return None
-
-                    if message.content.startswith('$mask'):
-                        draw_masks_on_faces(img, faces)
-                    elif message.content.startswith('$eyes'):
-                        draw_specific_points_on_faces(img, faces)
-                    elif message.content.startswith('$explainmin'):
-                        draw_letters_on_faces(img, faces, '')
-                    elif message.content.startswith('$explainfull'):
-                        draw_letters_on_faces(img, faces)
-                    else:
-                        draw_overlays_on_faces(img, faces)
-
-                    await send_img_to_channel(img, message.channel)
+                if _pending_images >= MAX_PENDING_IMAGES:
+                    logging.warning('Rejected image from message {message_id}, {pending_images} images pending',
+                                    message_id=message.id, pending_images=_pending_images)
+                    await message.reply('Liiga palju pilte korraga, proovi hiljem uuesti!')
+                    return None
+
+                _pending_images += 1
+                try:
+                    async with message.channel.typing():
+                        start = time.perf_counter()
+                        img_bytes = await attachment.read()
+                        download_ms = _elapsed_ms(start)
+                        executor = await get_executor()
+                        try:
+                            output_bytes, timings = await asyncio.get_running_loop().run_in_executor(
+                                executor, process_image, img_bytes, get_mode(message.content))
+                        except BrokenProcessPool:
+                            _executor = None
+                            raise
+                        logging.info('Processed image from message {message_id} in {total_ms} ms (cache {cache}): '
+                                     'download {download_ms}, decode {decode_ms}, detect {detect_ms}, draw {draw_ms}, '
+                                     'encode {encode_ms}',
+                                     message_id=message.id, total_ms=_elapsed_ms(start), download_ms=download_ms,
+                                     **{stage: timings.get(stage) for stage in
+                                        ('cache', 'decode_ms', 'detect_ms', 'draw_ms', 'encode_ms')})
+
+                        if output_bytes is None:
+                            logging.info('Message {message_id} didnt contain any faces', message_id=message.id)
+                            return None
+
+                        await send_img_to_channel(output_bytes, message.channel)
+                finally:
+                    _pending_images -= 1
 
 
 def draw_overlays_on_faces(img, faces):
+    overlays = overlay_index.get_overlays()
+    if not overlays:
+        logging.error(f"No usable overlays in {OVERLAYS_FOLDER}")
+        return img
+
     points_on_faces = get_specific_points_on_faces(img, faces)
+    source_stats = (calculate_average_brightness(img), calculate_average_contrast(img))
 
     for idx, face in enumerate(points_on_faces):
-        overlay_filename = random.choice(os.listdir(OVERLAYS_FOLDER))
-        overlay_path = os.path.join(OVERLAYS_FOLDER, overlay_filename)
-
-        overlay = get_img_from_path(overlay_path)
-        overlay = transform_overlay(img, overlay)
-        face_landmarks = faces.multi_face_landmarks[idx].landmark
-        best_overlay = choose_best_overlay(overlay, face_landmarks)
-        overlay_faces = get_faces(best_overlay, no_of_faces=1)
-        points_on_overlay_faces = get_specific_points_on_faces(best_overlay, overlay_faces)
-
-        p1_src = np.array(points_on_overlay_faces[0][0])
-        p2_src = np.array(points_on_overlay_faces[0][1])
+        if None in face:
+            continue
+        overlay = random.choice(overlays)
+        face_landmarks = faces[idx]
+        if should_flip_overlay(face_landmarks):
+            best_overlay, overlay_eyes = overlay.flipped, overlay.flipped_eyes
+        else:
+            best_overlay, overlay_eyes = overlay.image, overlay.eyes
+        best_overlay = transform_overlay(best_overlay, source_stats, overlay.stats)
+
+        p1_src = np.array(overlay_eyes[0])
+        p2_src = np.array(overlay_eyes[1])
 
         p1_dst = np.array(face[0])
         p2_dst = np.array(face[1])
@@ -78,19 +461,35 @@ def draw_overlays_on_faces(img, faces):
             [b_param, a, ty]
         ])
 
-        rows, cols = img.shape[:2]
-        transformed_overlay = cv2.warpAffine(best_overlay, M, (cols, rows))
-
-        y1, y2 = 0, 0 + transformed_overlay.shape[0]
-        x1, x2 = 0, 0 + transformed_overlay.shape[1]
+        blend_overlay(img, best_overlay, M)
 
-        alpha_s = transformed_overlay[:, :, 3] / 255.0
-        alpha_l = 1.0 - alpha_s
+    return img
 
-        for c in range(0, 3):
-            img[y1:y2, x1:x2, c] = (alpha_s * transformed_overlay[:, :, c] +
-                                    alpha_l * img[y1:y2, x1:x2, c])
 
+def blend_overlay(img, overlay, M):
+    """
+    Warps the RGBA overlay with M and alpha-blends it onto img, touching only the warped overlay's bounding box.
+    """
+    rows, cols = img.shape[:2]
+    h, w = overlay.shape[:2]
+    corners = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1]], dtype=np.float64) @ M.T
+    # One pixel of margin for the bilinear fringe around the overlay's edges
+    x1 = max(int(np.floor(corners[:, 0].min())) - 1, 0)
+    y1 = max(int(np.floor(corners[:, 1].min())) - 1, 0)
+    x2 = min(int(np.ceil(corners[:, 0].max())) + 1, cols)
+    y2 = min(int(np.ceil(corners[:, 1].max())) + 1, rows)
+    if x1 >= x2 or y1 >= y2:
+        return img
+
+    # Shift the transform so that the ROI's top-left corner becomes the origin
+    roi_M = M.copy()
+    roi_M[:, 2] -= (x1, y1)
+    warped = cv2.warpAffine(overlay, roi_M, (x2 - x1, y2 - y1))
+
+    # Fixed-point blend of all colour channels at once: (overlay * a + img * (255 - a)) / 255, rounded
+    roi = img[y1:y2, x1:x2, :3]
+    alpha = warped[:, :, 3:4].astype(np.uint16)
+    roi[...] = (warped[:, :, :3] * alpha + roi * (255 - alpha) + 127) // 255
     return img
 
 
@@ -99,16 +498,26 @@ def get_img_from_path(path):
     return overlay_img
 
 
-def choose_best_overlay(overlay, src_face_landmarks):
+def get_overlay_eyes(overlay):
+    overlay_faces = get_faces(overlay, no_of_faces=1)
+    if not len(overlay_faces):
+        return None
+    eyes = get_specific_points_on_faces(overlay, overlay_faces)[0]
+    if None in eyes:
+        return None
+    return [list(eye) for eye in eyes]
+
+
+def should_flip_overlay(src_face_landmarks):
     def get_face_orientation(landmarks):
         try:
             # Use raw normalized coordinates (0-1 range)
-            jaw_x = [lm.x for lm in landmarks[0:17]]  # Jaw points (0-16)
+            jaw_x = landmarks[0:17, 0]  # Jaw points (0-16)
             min_x = min(jaw_x)
             max_x = max(jaw_x)
             face_width = max_x - min_x
 
-            nose_x = landmarks[4].x
+            nose_x = landmarks[4, 0]
 
             face_center = (min_x + max_x) / 2
             offset = nose_x - face_center
@@ -136,83 +545,114 @@ def choose_best_overlay(overlay, src_face_landmarks):
     if src_orientation == "center":
         try:
             # Landmarks 33 (right eye inner) and 263 (left eye inner)
-            right_eye = src_face_landmarks[33].x
-            left_eye = src_face_landmarks[263].x
+            right_eye = src_face_landmarks[33, 0]
+            left_eye = src_face_landmarks[263, 0]
             should_flip = left_eye > right_eye  # Eyes cross center
         except Exception as e:
             logging.error(f"Eye fallback error: {str(e)}")
             should_flip = False
 
     logging.info(f"Orientation: {src_orientation}, Flip: {should_flip}")
-    return cv2.flip(overlay, 1) if should_flip else overlay
+    return should_flip
 
 
-async def get_img_from_attachment(attachment):
-    img_bytes = await attachment.read()
+def decode_img(img_bytes):
     np_arr = np.frombuffer(img_bytes, np.uint8)
     img = cv2.imdecode(np_arr, cv2.IMREAD_UNCHANGED)
     return img
 
 
+def resize_for_detection(img, max_side=DETECT_MAX_SIDE):
+    rows, cols = img.shape[:2]
+    scale = max_side / max(rows, cols)
+    if scale >= 1:
+        return img
+    return cv2.resize(img, (round(cols * scale), round(rows * scale)), interpolation=cv2.INTER_LINEAR)
+
+
 def get_faces(img, no_of_faces=10):
-    face_mesh = mp.solutions.face_mesh.FaceMesh(
-        static_image_mode=True,
-        max_num_faces=no_of_faces,
-        refine_landmarks=True,
-        min_detection_confidence=0.5)
-    faces = face_mesh.process(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
-    return faces
+    """
+    Returns the normalized (x, y, z) landmarks of every face on img as an array of shape (faces, 478, 3).
+    The models only see a copy downscaled to DETECT_MAX_SIDE; normalized coordinates map straight back onto img.
+    """
+    rgb = cv2.cvtColor(resize_for_detection(img), cv2.COLOR_BGR2RGB)
+
+    with get_model_pool('face_detection', create_face_detection).checkout() as face_detection:
+        if not face_detection.process(rgb).detections:
+            return NO_FACES
+
+    face_mesh_pool = get_model_pool(f'face_mesh_{no_of_faces}', lambda: create_face_mesh(no_of_faces))
+    with face_mesh_pool.checkout() as face_mesh:
+        faces = face_mesh.process(rgb)
+    if not faces.multi_face_landmarks:
+        return NO_FACES
+    return np.array([[(lm.x, lm.y, lm.z) for lm in face.landmark] for face in faces.multi_face_landmarks])
+
+
+def landmarks_to_pixels(img, faces):
+    """
+    Converts normalized landmarks of shape (faces, points, 3) to pixel coordinates of shape (faces, points, 2)
+    the same way as _normalized_to_pixel_coordinates, also returns a mask of the points that are inside the image.
+    """
+    image_rows, image_cols = img.shape[:2]
+    xy = faces[..., :2]
+    valid = np.all((xy >= 0) & (xy <= 1), axis=-1)
+    cords = np.floor(xy * (image_cols, image_rows)).astype(np.int32)
+    np.minimum(cords, (image_cols - 1, image_rows - 1), out=cords)
+    return cords, valid
+
+
+@lru_cache(maxsize=None)
+def get_glyph_sprite(text):
+    """
+    Renders the text once with the same putText settings as before and returns the (dy, dx) offsets of its pixels
+    relative to the text origin, so it can be stamped on any number of points at once.
+    """
+    (width, height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.3, 2)
+    pad = 4
+    canvas = np.zeros((height + baseline + 2 * pad, width + 2 * pad), np.uint8)
+    origin = (pad, pad + height)
+    cv2.putText(canvas, text, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.3, 255, 2)
+    dy, dx = np.nonzero(canvas)
+    return dy - origin[1], dx - origin[0]
+
+
+def stamp_glyph(img, text, cords):
+    if not text or not len(cords):
+        return
+    dy, dx = get_glyph_sprite(text)
+    ys = (cords[:, 1, None] + dy).ravel()
+    xs = (cords[:, 0, None] + dx).ravel()
+    inside = (ys >= 0) & (ys < img.shape[0]) & (xs >= 0) & (xs < img.shape[1])
+    img[ys[inside], xs[inside], :3] = LANDMARK_COLOR
 
 
 def draw_masks_on_faces(img, faces):
-    image_rows, image_cols, _ = img.shape
-    for face in faces.multi_face_landmarks:
-        for mask_point in face.landmark:
-            cord = _normalized_to_pixel_coordinates(mask_point.x, mask_point.y, image_cols, image_rows)
-            cv2.putText(img, '.', cord, cv2.FONT_HERSHEY_SIMPLEX, 0.3, (0, 0, 255), 2)
+    cords, valid = landmarks_to_pixels(img, faces)
+    stamp_glyph(img, '.', cords[valid])
 
 
 def draw_specific_points_on_faces(img, faces, points=[33, 263]):
-    image_rows, image_cols, _ = img.shape
-    for face in faces.multi_face_landmarks:
-        all_points = face.landmark
-        for mask_point in points:
-            cord = _normalized_to_pixel_coordinates(all_points[mask_point].x, all_points[mask_point].y, image_cols,
-                                                    image_rows)
-            cv2.putText(img, '.', cord, cv2.FONT_HERSHEY_SIMPLEX, 0.3, (0, 0, 255), 2)
+    cords, valid = landmarks_to_pixels(img, faces[:, points])
+    stamp_glyph(img, '.', cords[valid])
 
 
 def draw_letters_on_faces(img, faces, alt='.'):
-    image_rows, image_cols, _ = img.shape
-    letters = {
-        33: 'l',
-        159: 't',
-        133: 'r',
-        145: 'b',
-        362: 'L',
-        386: 'T',
-        263: 'R',
-        374: 'B',
-        61: 'm',  # may be wrong
-        409: 'M',  # wrong but close
-    }
-    for face in faces.multi_face_landmarks:
-        all_points = face.landmark
-        for mask_point in range(len(all_points)):
-            cord = _normalized_to_pixel_coordinates(all_points[mask_point].x, all_points[mask_point].y, image_cols,
-                                                    image_rows)
-            cv2.putText(img, alt if mask_point not in letters else letters[mask_point], cord, cv2.FONT_HERSHEY_SIMPLEX,
-                        0.3, (0, 0, 255), 2)
+    cords, valid = landmarks_to_pixels(img, faces)
+    is_letter = np.zeros(faces.shape[1], bool)
+    is_letter[list(FACE_LETTERS)] = True
+    stamp_glyph(img, alt, cords[valid & ~is_letter])
+    for mask_point, letter in FACE_LETTERS.items():
+        stamp_glyph(img, letter, cords[valid[:, mask_point], mask_point])
 
 
 def get_specific_points_on_faces(img, faces, points=[33, 263]):
     points_on_faces = []
     image_rows, image_cols, _ = img.shape
-    for face in faces.multi_face_landmarks:
-        all_points = face.landmark
+    for all_points in faces:
         points_on_face = []
         for mask_point in points:
-            cord = _normalized_to_pixel_coordinates(all_points[mask_point].x, all_points[mask_point].y, image_cols,
+            cord = _normalized_to_pixel_coordinates(all_points[mask_point, 0], all_points[mask_point, 1], image_cols,
                                                     image_rows)
             points_on_face.append(cord)
         points_on_faces.append(points_on_face)
@@ -225,10 +665,54 @@ def draw_points_on_faces(img, points_on_faces):
             cv2.putText(img, '.', point, cv2.FONT_HERSHEY_SIMPLEX, 0.3, (0, 0, 255), 2)
 
 
-async def send_img_to_channel(img, channel):
-    _, buffer = cv2.imencode('.png', img)
-    output_bytes = buffer.tobytes()
-    await channel.send(file=discord.File(fp=io.BytesIO(output_bytes), filename='output.png'))
+def get_output_format(img, img_bytes=b'', mode='overlay'):
+    if img.ndim == 3 and img.shape[2] == 4:
+        return 'png'
+    if OUTPUT_FORMAT != 'auto':
+        return OUTPUT_FORMAT
+    # Only photos with faces pasted on them go lossy, screenshots and the 1-2 px annotation glyphs would smear
+    if mode != 'overlay' or img_bytes.startswith(PNG_SIGNATURE):
+        return 'png'
+    return 'jpeg'
+
+
+def encode_img(img, output_format=None, sharp=False):
+    """
+    Encodes the rendered image for upload in output_format (see get_output_format), optionally downscaled to
+    OUTPUT_MAX_SIDE. A PNG too large for Discord falls back to JPEG. Sharp images are encoded as JPEG without
+    chroma subsampling, so thin colored lines keep their color.
+    """
+    if OUTPUT_MAX_SIDE and max(img.shape[:2]) > OUTPUT_MAX_SIDE:
+        scale = OUTPUT_MAX_SIDE / max(img.shape[:2])
+        img = cv2.resize(img, (round(img.shape[1] * scale), round(img.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+    output_format = output_format or get_output_format(img)
+    if output_format == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, OUTPUT_QUALITY]
+        if sharp:
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444]
+        _, buffer = cv2.imencode('.jpg', img, params)
+    elif output_format == 'webp':
+        _, buffer = cv2.imencode('.webp', img, [cv2.IMWRITE_WEBP_QUALITY, OUTPUT_QUALITY])
+    else:
+        _, buffer = cv2.imencode('.png', img)
+        if buffer.size > MAX_UPLOAD_BYTES:
+            return encode_img(img[:, :, :3] if img.ndim == 3 else img, 'jpeg', sharp=True)
+    # The worker has to hand bytes back to the bot process anyway, this is the only copy of the encoded data
+    return buffer.tobytes()
+
+
+def get_img_extension(output_bytes):
+    if output_bytes[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if output_bytes[:4] == b'RIFF' and output_bytes[8:12] == b'WEBP':
+        return 'webp'
+    return 'png'
+
+
+async def send_img_to_channel(output_bytes, channel):
+    # BytesIO shares the bytes object's buffer instead of copying it
+    await channel.send(file=discord.File(fp=io.BytesIO(output_bytes), filename=f'output.{get_img_extension(output_bytes)}'))
 
 
 def calculate_average_brightness(image):
@@ -239,12 +723,9 @@ def calculate_average_contrast(image):
     return np.std(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
 
 
-def transform_overlay(image, overlay_image):
-    # Calculate average brightness and contrast for both images
-    source_brightness = calculate_average_brightness(image)
-    source_contrast = calculate_average_contrast(image)
-    overlay_brightness = calculate_average_brightness(overlay_image)
-    overlay_contrast = calculate_average_contrast(overlay_image)
+def transform_overlay(overlay_image, source_stats, overlay_stats):
+    source_brightness, source_contrast = source_stats
+    overlay_brightness, overlay_contrast = overlay_stats
 
     # Adjust overlay brightness and contrast based on source image
     contrast_factor = source_contrast / overlay_contrast if overlay_contrast != 0 else 1
@@ -263,3 +744,7 @@ def transform_overlay(image, overlay_image):
         transformed_overlay = cv2.convertScaleAbs(overlay_image, alpha=contrast_factor, beta=brightness_adjustment)
 
     return transformed_overlay
+
+
+overlay_index = OverlayIndex()
+result_cache = ResultCache()
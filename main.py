@@ -2,21 +2,24 @@ import discord
 from discord.ext import commands, tasks
 import os
 import sys
-import traceback
 import seqlog
 import logging
 import gzip
+import multiprocessing
 import random
+from functools import partial
 from datetime import datetime, date
 
-from reminder import try_handle_remind_me, load_reminders
-from gym import try_handle_mhm
-from reputation import try_handle_bad_bot, try_handle_good_bot, try_handle_reaction_bot, try_handle_greeting
+from reminder import try_handle_remind_me, try_handle_list_reminders, try_handle_cancel_reminder, load_reminders
+from gym import try_handle_mhm, warm_occupancy_cache
+from reputation import try_handle_bad_bot, try_handle_good_bot, try_handle_reaction_bot, try_handle_greeting, \
+    BAD_WORDS, GOOD_WORDS
 from timeteller import try_handle_risto_time, try_handle_silver_time
-from instantmeme import try_handle_instant_meme
-from ace import try_handle_ace
+from instantmeme import try_handle_instant_meme, start_image_workers, IMAGE_EXTENSIONS
+from ace import try_handle_ace, start_eval_workers
 from impersonate import try_handle_impersonation
-from ai import try_handle_ai
+from ai import try_handle_ai, try_handle_ai_stats
+from router import MessageRouter
 
 logging.basicConfig(level=logging.INFO)
 handler = seqlog.log_to_seq(
@@ -64,6 +67,37 @@ async def try_handle_uptime(message: discord.Message):
         )
 
 
+async def try_handle_handler_stats(message):
+    if message.content.startswith('$handlerstats'):
+        await message.channel.send("```\n" + "\n".join(router.stats()) + "\n```")
+
+
+async def reply_handler_error(message, route):
+    await message.reply('UPSI WUPSI!! Uwu ma tegin nussi-vussi!! Wäikese kebo bongo! Ergo näeb KÕWA WAEWA, et see ära parandada nii kiiresti kui ta heaks arvab.')
+
+
+router = MessageRouter(bot, on_error=reply_handler_error)
+router.register(try_handle_uptime, prefixes=['$uptime'])
+router.register(try_handle_mhm, keywords=['mhm'])
+router.register(partial(try_handle_remind_me, bot), prefixes=['$remindme'])
+router.register(try_handle_list_reminders, prefixes=['$reminders'])
+router.register(try_handle_cancel_reminder, prefixes=['$cancelreminder'])
+router.register(try_handle_bad_bot, keywords=BAD_WORDS)
+router.register(partial(try_handle_good_bot, bot), keywords=GOOD_WORDS)
+router.register(partial(try_handle_reaction_bot, bot), catch_all=True)
+router.register(try_handle_risto_time, prefixes=['$ristotime'])
+router.register(try_handle_silver_time, prefixes=['$silvertime'])
+router.register(try_handle_help, prefixes=['$help'])
+router.register(try_handle_handler_stats, prefixes=['$handlerstats'])
+# $impersonate and $react delete the message, so the meme handler has to read its attachments first
+router.register(try_handle_instant_meme, attachments=IMAGE_EXTENSIONS, ordered=True)
+router.register(try_handle_ace, prefixes=['eval'])
+router.register(partial(try_handle_impersonation, bot), prefixes=['$react', '$impersonate'], ordered=True)
+router.register(try_handle_greeting, catch_all=True)
+router.register(partial(try_handle_ai, bot), mention=True)
+router.register(try_handle_ai_stats, prefixes=['$aistats'])
+
+
 @bot.event
 async def on_ready():
     global start_time, cached_channel
@@ -72,6 +106,9 @@ async def on_ready():
     logging.info(f'We have logged in as {bot.user}')
     activity = discord.Activity(type=discord.ActivityType.listening, name="AI-Podcast: Poopoo Peepee")
     await bot.change_presence(status=discord.Status.online, activity=activity)
+    start_eval_workers()
+    if not warm_occupancy_cache.is_running():
+        warm_occupancy_cache.start()
     await load_reminders(bot)
     try:
         await bot.load_extension("bank")
@@ -87,6 +124,8 @@ async def on_ready():
         await cached_channel.send(f"🔄 PIRRRAAAKIII, ma olen tagasi {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
     else:
         logging.error(f"Could not find channel with ID {startup_channel_id}")
+    # Last, so that a cold start building the overlay index doesn't hold up the rest
+    await start_image_workers()
 
 
 @tasks.loop(minutes=5.0)
@@ -108,50 +147,14 @@ async def word_of_the_day_task():
 async def on_message(message):
     if message.author == bot.user:
         return
-    try:
-        await try_handle_uptime(message)
-
-        await try_handle_mhm(message)
-
-        await try_handle_remind_me(bot, message)
-
-        await try_handle_bad_bot(message)
-
-        await try_handle_good_bot(bot, message)
-
-        await try_handle_reaction_bot(bot, message)
-
-        await try_handle_risto_time(message)
-
-        await try_handle_silver_time(message)
-
-        await try_handle_help(message)
-
-        await try_handle_instant_meme(message)
-
-        await try_handle_ace(message)
-
-        await try_handle_impersonation(bot, message)
-
-        await try_handle_greeting(message)
-
-        #await try_handle_flex(message)
-
-        #await try_handle_beg(message)
-
-        #await try_handle_daily(message)
-
-        #await try_handle_bet(message)
-
-        #await try_handle_balance(message)
-
-        await try_handle_ai(bot, message)
-
-    except Exception:
-        logging.exception(traceback.format_exc())
-        await message.reply('UPSI WUPSI!! Uwu ma tegin nussi-vussi!! Wäikese kebo bongo! Ergo näeb KÕWA WAEWA, et see ära parandada nii kiiresti kui ta heaks arvab.')
-
+    await router.dispatch(message)
     sys.stdout.flush()
 
 
-bot.run(os.environ.get('TOKEN'), log_handler=handler)
+if __name__ == '__main__':
+    # The image and ace workers are forked from the running bot, so they start at once and share the imported modules
+    # and the overlay index. Spawn or forkserver would import this module again in every worker instead. The bot
+    # already runs threads when they fork, so workers only use what they set up themselves, never the parent's
+    # database connections or event loop.
+    multiprocessing.set_start_method('fork')
+    bot.run(os.environ.get('TOKEN'), log_handler=handler)
@@ -1,20 +1,42 @@
 import asyncio
+import heapq
+import os
 import sqlite3
 import re
 from datetime import datetime, timedelta
 import logging
+from dbthread import DbThread
 
-conn = sqlite3.connect('data/reminders.db')
-c = conn.cursor()
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Only reminders due within this window are kept in memory, the rest are loaded from the database when it moves on
+REMINDER_WINDOW = timedelta(hours=int(os.environ.get('REMINDER_WINDOW_HOURS', '6')))
+MAX_LISTED_REMINDERS = 20
+# Seconds between the messages that deliver reminders missed while the bot was down
+CATCHUP_INTERVAL = float(os.environ.get('REMINDER_CATCHUP_INTERVAL', '1'))
+MAX_MESSAGE_LENGTH = 2000
 
-# Create a table to store reminders if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS reminders (
-    user_id INTEGER,
-    channel_id INTEGER,
-    reminder_message TEXT,
-    remind_at DATETIME
-)''')
-conn.commit()
+DB_NAME = 'data/reminders.db'
+
+
+def _create_tables(conn):
+    # Create a table to store reminders if it doesn't exist
+    conn.execute('''CREATE TABLE IF NOT EXISTS reminders (
+        user_id INTEGER,
+        channel_id INTEGER,
+        reminder_message TEXT,
+        remind_at DATETIME
+    )''')
+    # remind_at is stored as '%Y-%m-%d %H:%M:%S' text, which sorts and compares like the datetime itself
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reminders_remind_at ON reminders (remind_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders (user_id, remind_at)')
+    conn.commit()
+
+
+db = DbThread(DB_NAME, 'reminder-db', init=_create_tables)
+db.submit(db.get_connection).result()
+
+
+scheduler = None
 
 
 # Function to convert time with units into seconds
@@ -39,54 +61,222 @@ def convert_time_to_seconds(time_str):
     return value * time_multipliers.get(unit, 0)
 
 
-# Function to save a reminder to the database
+def _insert_reminder(user_id, channel_id, message, remind_at):
+    conn = db.get_connection()
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO reminders (user_id, channel_id, reminder_message, remind_at) VALUES (?, ?, ?, ?)",
+            (user_id, channel_id, message, remind_at))
+    return cursor.lastrowid
+
+
+def _load_due_reminders(after, until):
+    conn = db.get_connection()
+    if after is None:
+        return conn.execute("SELECT rowid, * FROM reminders WHERE remind_at <= ? ORDER BY remind_at",
+                            (until,)).fetchall()
+    return conn.execute("SELECT rowid, * FROM reminders WHERE remind_at > ? AND remind_at <= ? ORDER BY remind_at",
+                        (after, until)).fetchall()
+
+
+def _list_user_reminders(user_id, limit):
+    conn = db.get_connection()
+    return conn.execute(
+        "SELECT rowid, reminder_message, remind_at FROM reminders WHERE user_id = ? ORDER BY remind_at LIMIT ?",
+        (user_id, limit)).fetchall()
+
+
+def _delete_user_reminder(rowid, user_id):
+    conn = db.get_connection()
+    with conn:
+        cursor = conn.execute("DELETE FROM reminders WHERE rowid = ? AND user_id = ?", (rowid, user_id))
+    return cursor.rowcount > 0
+
+
+def _delete_reminders(rowids):
+    conn = db.get_connection()
+    with conn:
+        conn.executemany("DELETE FROM reminders WHERE rowid = ?", [(rowid,) for rowid in rowids])
+
+
+# Function to save a reminder to the database, returns its rowid
 async def save_reminder(user_id, channel_id, message, remind_at):
-    try:
-        c.execute("INSERT INTO reminders (user_id, channel_id, reminder_message, remind_at) VALUES (?, ?, ?, ?)",
-                  (user_id, channel_id, message, remind_at))
-        conn.commit()
-    except sqlite3.Error as e:
-        await message.channel.send(f"Täitsa kuradi jama! Kutsuge on-call: {str(e)}")
+    return await db.run(_insert_reminder, user_id, channel_id, message, remind_at.strftime(TIME_FORMAT))
+
+
+async def load_due_reminders(after, until):
+    rows = await db.run(_load_due_reminders, after and after.strftime(TIME_FORMAT), until.strftime(TIME_FORMAT))
+    return [(rowid, user_id, channel_id, message, datetime.strptime(remind_at, TIME_FORMAT))
+            for rowid, user_id, channel_id, message, remind_at in rows]
+
+
+async def list_user_reminders(user_id, limit=MAX_LISTED_REMINDERS):
+    return await db.run(_list_user_reminders, user_id, limit)
+
+
+async def delete_user_reminder(rowid, user_id):
+    return await db.run(_delete_user_reminder, rowid, user_id)
+
 
+# Deletes all the given reminders in one transaction
+async def delete_reminders(rowids):
+    await db.run(_delete_reminders, rowids)
 
-# Function to load reminders and resume waiting for them
+
+class ReminderScheduler:
+    """
+    Keeps the reminders due within REMINDER_WINDOW in a min-heap and runs a single task that sleeps until the
+    earliest of them (or the end of the window). A new reminder that becomes the earliest wakes it up early.
+    Cancelled reminders are dropped from the entries and their heap items are skipped when they come up.
+
+    Reminders that were already overdue at startup don't go into the heap, a separate task delivers them
+    grouped per channel so that they don't hold up startup or the reminders that are due on time.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._heap = []
+        self._entries = {}
+        self._window_end = None
+        self._loading_cancelled = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._catchup_task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def add(self, rowid, user_id, channel_id, message, remind_at):
+        # Reminders past the loaded window are picked up from the database when the window gets there
+        if self._window_end is None or remind_at > self._window_end or rowid in self._entries:
+            return
+        self._entries[rowid] = (user_id, channel_id, message)
+        heapq.heappush(self._heap, (remind_at, rowid))
+        if self._heap[0][1] == rowid:
+            self._wakeup.set()
+
+    def cancel(self, rowid):
+        self._entries.pop(rowid, None)
+        if self._loading_cancelled is not None:
+            self._loading_cancelled.add(rowid)
+
+    async def _load_window(self, now):
+        # The window moves before the query, so reminders saved meanwhile are added directly and deduplicated by rowid
+        after, self._window_end = self._window_end, (now + REMINDER_WINDOW).replace(microsecond=0)
+        self._loading_cancelled = set()
+        overdue = []
+        try:
+            for rowid, user_id, channel_id, message, remind_at in await load_due_reminders(after, self._window_end):
+                if rowid in self._loading_cancelled or rowid in self._entries:
+                    continue
+                if after is None and remind_at <= now:
+                    self._entries[rowid] = (user_id, channel_id, message)
+                    overdue.append(rowid)
+                else:
+                    self.add(rowid, user_id, channel_id, message, remind_at)
+        finally:
+            self._loading_cancelled = None
+        if overdue:
+            logging.info(f"Catching up on {len(overdue)} overdue reminders")
+            self._catchup_task = asyncio.create_task(self._catch_up(overdue))
+
+    async def _catch_up(self, rowids):
+        by_channel = {}
+        for rowid in rowids:
+            by_channel.setdefault(self._entries[rowid][1], []).append(rowid)
+
+        for channel_rowids in by_channel.values():
+            # Taken only now, so reminders cancelled while waiting for their turn are skipped
+            reminders = [(rowid, *self._entries.pop(rowid)) for rowid in channel_rowids if rowid in self._entries]
+            if reminders:
+                await send_reminders(self.client, reminders, CATCHUP_INTERVAL)
+                await asyncio.sleep(CATCHUP_INTERVAL)
+
+    def _next_wakeup(self):
+        while self._heap and self._heap[0][1] not in self._entries:
+            heapq.heappop(self._heap)
+        if self._heap:
+            return min(self._heap[0][0], self._window_end)
+        return self._window_end
+
+    async def _run(self):
+        while True:
+            now = datetime.now()
+            if self._window_end is None or now >= self._window_end:
+                try:
+                    await self._load_window(now)
+                except sqlite3.Error as e:
+                    logging.error(f"Raisk! Error loading reminders: {e}")
+                    self._window_end = None
+                    await asyncio.sleep(60)
+                    continue
+
+            fired = []
+            while self._heap and self._heap[0][0] <= now:
+                _, rowid = heapq.heappop(self._heap)
+                entry = self._entries.pop(rowid, None)
+                if entry is not None:
+                    fired.append((rowid, *entry))
+            if fired:
+                await send_reminders(self.client, fired)
+
+            self._wakeup.clear()
+            delay = (self._next_wakeup() - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+
+# Function to start the reminder scheduler, it loads and resumes waiting for the saved reminders in the background
 async def load_reminders(client):
-    try:
-        c.execute("SELECT rowid, * FROM reminders")
-        reminders = c.fetchall()
-        now = datetime.now()
-
-        for reminder in reminders:
-            rowid, user_id, channel_id, message, remind_at = reminder
-            remind_at_dt = datetime.strptime(remind_at, '%Y-%m-%d %H:%M:%S')
-            remaining_seconds = (remind_at_dt - now).total_seconds()
-
-            if remaining_seconds > 0:
-                asyncio.create_task(schedule_reminder(rowid, user_id, channel_id, message, remaining_seconds, client))
-            else:
-                await send_reminder(rowid, user_id, channel_id, message, client)
-    except sqlite3.Error as e:
-        logging.error("Raisk! Error loading reminders", e)
+    global scheduler
+    if scheduler is None:
+        scheduler = ReminderScheduler(client)
+    scheduler.start()
+
 
+def group_reminder_messages(reminders):
+    """
+    Combines (rowid, user_id, channel_id, message) reminders into as few messages per channel as Discord allows,
+    yields (channel_id, rowids, text).
+    """
+    by_channel = {}
+    for rowid, user_id, channel_id, message in reminders:
+        by_channel.setdefault(channel_id, []).append((rowid, f"<@{user_id}>, {message}"))
 
-# Function to wait and send the reminder
-async def schedule_reminder(rowid, user_id, channel_id, message, wait_time, client):
-    await asyncio.sleep(wait_time)
-    await send_reminder(rowid, user_id, channel_id, message, client)
+    for channel_id, lines in by_channel.items():
+        rowids, chunk, length = [], [], 0
+        for rowid, line in lines:
+            if chunk and length + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                yield channel_id, rowids, "\n".join(chunk)
+                rowids, chunk, length = [], [], 0
+            rowids.append(rowid)
+            chunk.append(line)
+            length += len(line) + 1
+        yield channel_id, rowids, "\n".join(chunk)
 
 
-# Function to send the reminder
-async def send_reminder(rowid, user_id, channel_id, message, client):
-    channel = client.get_channel(channel_id)
-    if channel:
-        await channel.send(f"<@{user_id}>, {message}")
+# Function to send the reminders, pausing interval seconds between messages
+async def send_reminders(client, reminders, interval=0.0):
+    rowids = []
+    for i, (channel_id, chunk_rowids, text) in enumerate(group_reminder_messages(reminders)):
+        if i and interval:
+            await asyncio.sleep(interval)
+        channel = client.get_channel(channel_id)
+        if channel:
+            try:
+                await channel.send(text)
+            except Exception:
+                logging.exception(f"Could not send reminders {chunk_rowids} to channel {channel_id}")
+        rowids.extend(chunk_rowids)
 
-    # Delete reminder from database after sending
+    # Delete reminders from database after sending
     try:
-        c.execute("DELETE FROM reminders WHERE rowid = ?", (rowid,))
-        conn.commit()
+        await delete_reminders(rowids)
     except sqlite3.Error as e:
-        await message.channel.send(f"Täitsa loll lugu! Ei kustu ju ära: {str(e)}")
+        logging.error(f"Täitsa loll lugu! Ei kustu ju ära: {e}")
 
 
 async def try_handle_remind_me(client, message):
@@ -108,17 +298,46 @@ async def try_handle_remind_me(client, message):
                     "Aeg on vittus ju! Number ja unit (seconds, minutes, hours, days, months, or years).")
                 return
 
-            # Calculate when the reminder should be triggered
-            remind_at = datetime.now() + timedelta(seconds=time_in_seconds)
+            # Calculate when the reminder should be triggered, rounded up to whole seconds like the stored text
+            remind_at = datetime.now().replace(microsecond=0) + timedelta(seconds=time_in_seconds + 1)
 
             # Save the reminder to the database
-            save_reminder(message.author.id, message.channel.id, reminder_message,
-                          remind_at.strftime('%Y-%m-%d %H:%M:%S'))
-            asyncio.create_task(
-                schedule_reminder(None, message.author.id, message.channel.id, reminder_message, time_in_seconds,
-                                  client))
+            try:
+                rowid = await save_reminder(message.author.id, message.channel.id, reminder_message, remind_at)
+            except sqlite3.Error as e:
+                await message.channel.send(f"Täitsa kuradi jama! Kutsuge on-call: {str(e)}")
+                return
+            if scheduler is not None:
+                scheduler.add(rowid, message.author.id, message.channel.id, reminder_message, remind_at)
 
-            await message.channel.send(f"Paras idikas, tuletan siis meelde! \"{reminder_message}\" - {time_str}")
+            await message.channel.send(
+                f"Paras idikas, tuletan siis meelde! \"{reminder_message}\" - {time_str} (#{rowid})")
 
         except Exception as e:
             await message.channel.send(f"Johhaidii, mingi jama juhtus: {str(e)}")
+
+
+async def try_handle_list_reminders(message):
+    if message.content.startswith('$reminders'):
+        reminders = await list_user_reminders(message.author.id)
+        if not reminders:
+            await message.channel.send("Sul pole ühtegi meeldetuletust.")
+            return
+        lines = [f"#{rowid} {remind_at} - \"{reminder_message}\"" for rowid, reminder_message, remind_at in reminders]
+        await message.channel.send("\n".join(lines))
+
+
+async def try_handle_cancel_reminder(message):
+    if message.content.startswith('$cancelreminder'):
+        match = re.match(r'\$cancelreminder\s*#?(\d+)', message.content)
+        if not match:
+            await message.channel.send("Proovi: $cancelreminder <number> (vaata $reminders).")
+            return
+
+        rowid = int(match.group(1))
+        if not await delete_user_reminder(rowid, message.author.id):
+            await message.channel.send(f"Sellist meeldetuletust pole: #{rowid}")
+            return
+        if scheduler is not None:
+            scheduler.cancel(rowid)
+        await message.channel.send(f"Olgu, unustan ära: #{rowid}")
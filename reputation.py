@@ -1,22 +1,23 @@
 import random
 import re
 
+BAD_WORDS = [
+    "bad bot", "halb bot", "loll bot", "rumal bot", "idioot", "tüütu", "munn", "perse",
+    "debiilik", "lollakas", "põmmpea", "tolvan", "värdjas", "mölakas", "idikas", "idioot bot"
+]
+
+GOOD_WORDS = [
+    "good bot", "hea bot", "tubli bot", "aitäh", "tubli", "suurepärane", "vinge",
+    "äge", "mulle meeldib", "fantastiline", "tänan", "tänud", "huvä"
+]
 
 async def try_handle_bad_bot(message):
-    bad_words = [
-        "bad bot", "halb bot", "loll bot", "rumal bot", "idioot", "tüütu", "munn", "perse",
-        "debiilik", "lollakas", "põmmpea", "tolvan", "värdjas", "mölakas", "idikas", "idioot bot"
-    ]
-    if any(word in message.content.lower() for word in bad_words):
+    if any(word in message.content.lower() for word in BAD_WORDS):
         await message.add_reaction('😢')
 
 
 async def try_handle_good_bot(client, message):
-    good_words = [
-        "good bot", "hea bot", "tubli bot", "aitäh", "tubli", "suurepärane", "vinge",
-        "äge", "mulle meeldib", "fantastiline", "tänan", "tänud", "huvä"
-    ]
-    if any(word in message.content.lower() for word in good_words):
+    if any(word in message.content.lower() for word in GOOD_WORDS):
         emoji = client.get_emoji(1291820499420053677)
         await message.add_reaction(emoji)
 
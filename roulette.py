@@ -19,33 +19,30 @@ class RouletteCog(commands.Cog):
             await interaction.response.send_message(content="Nii väikese panusega sind mängu ei võeta!")
             return
       
-        balance = bank.get_balance(interaction.user)
-        if amount > balance:
-            await interaction.response.send_message(content=f"Jää oma võimekuse piiridesse! (max panus sulle: {balance})")
-            return
-
-        if not bank.withdraw(interaction.user, amount):
-            await interaction.response.send_message(sontent = "Sa oleks peaaegu kasiinolt raha petnud!")
-            return
-      
-        bank.withdraw_limitless(self.bot.user, amount)
-
         number = random.randint(0, 36)
         result_color = 'red' if number in RED_NUMBERS else 'black' if number != 0 else 'green'
 
-        if result_color == color:
-            if result_color == 'green':
-                winnings = amount * 35
+        async with bank.transaction() as tx:
+            tx.withdraw(interaction.user, amount)
+            tx.withdraw_limitless(self.bot.user, amount)
+
+            if result_color == color:
+                if result_color == 'green':
+                    winnings = amount * 35
+                else:
+                    winnings = amount
+
+                tx.deposit(interaction.user, winnings*2)
+                result_msg = f"Pall maandus {number} ({result_color}). Võitsid {winnings} eurot!"
             else:
-                winnings = amount
-            
-            bank.deposit(interaction.user, winnings*2)
-            result_msg = f"Pall maandus {number} ({result_color}). Võitsid {winnings} eurot!"
-        else:
-            bank.deposit(self.bot.user, amount*2)
-            result_msg = f"Pall maandus {number} ({result_color}). Kaotasid {amount} eurot."
-
-        balance = bank.get_balance(interaction.user)
+                tx.deposit(self.bot.user, amount*2)
+                result_msg = f"Pall maandus {number} ({result_color}). Kaotasid {amount} eurot."
+
+        balance = tx.balance(interaction.user)
+        if not tx.committed:
+            await interaction.response.send_message(content=f"Jää oma võimekuse piiridesse! (max panus sulle: {balance})")
+            return
+
         await interaction.response.send_message(content=f"{result_msg} Su uus balanss on {balance} eurot.")
 
 async def setup(bot: commands.Bot):
@@ -0,0 +1,198 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+_END = ''
+
+
+class _KeywordAutomaton:
+    """
+    Aho-Corasick automaton, finds every registered keyword in a single pass over the text.
+    """
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        self._built = True
+
+    def add(self, keyword, value):
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+            node = nxt
+        self._out[node].add(value)
+        self._built = False
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+        self._built = True
+
+    def search(self, text):
+        if not self._built:
+            self._build()
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found |= out[node]
+        return found
+
+
+class Route:
+    def __init__(self, name, handler, ordered=False):
+        self.name = name
+        self.handler = handler
+        self.ordered = ordered
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+
+def _handler_name(handler):
+    while not hasattr(handler, '__name__') and hasattr(handler, 'func'):
+        handler = handler.func
+    return getattr(handler, '__name__', repr(handler))
+
+
+class MessageRouter:
+    """
+    Dispatches a message only to the handlers whose declared trigger matches it.
+
+    Triggers are content prefixes (case-sensitive, like str.startswith), keywords
+    (case-insensitive substrings), attachment extensions, a mention of the bot or catch-all.
+
+    With concurrent=True every matching handler runs as its own task. Handlers registered with
+    ordered=True share a single task and run one after another in registration order, for the
+    few that must not race each other. A failing handler is logged and reported through on_error
+    without affecting the others.
+    """
+    def __init__(self, client, concurrent=True, on_error=None):
+        self.client = client
+        self.concurrent = concurrent
+        self.on_error = on_error
+        self.routes = []
+        self._prefixes = {}
+        self._keywords = _KeywordAutomaton()
+        self._attachments = {}
+        self._mentions = []
+        self._mention_id = None
+        self._catch_all = []
+
+    def register(self, handler, *, prefixes=(), keywords=(), attachments=(), mention=False, catch_all=False,
+                 ordered=False, name=None):
+        index = len(self.routes)
+        self.routes.append(Route(name or _handler_name(handler), handler, ordered))
+
+        for prefix in prefixes:
+            node = self._prefixes
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node.setdefault(_END, []).append(index)
+        for keyword in keywords:
+            self._keywords.add(keyword.lower(), index)
+        for ext in attachments:
+            self._attachments.setdefault(ext.lower(), []).append(index)
+        if mention:
+            self._mentions.append(index)
+        if catch_all:
+            self._catch_all.append(index)
+        return handler
+
+    def _register_mentions(self):
+        user_id = self.client.user.id
+        if self._mention_id == user_id:
+            return
+        self._mention_id = user_id
+        for index in self._mentions:
+            self._keywords.add(f"<@{user_id}>", index)
+            self._keywords.add(f"<@!{user_id}>", index)
+
+    def match(self, message):
+        content = message.content
+        matched = set(self._catch_all)
+
+        node = self._prefixes
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            matched.update(node.get(_END, ()))
+
+        if self._mentions:
+            self._register_mentions()
+        matched |= self._keywords.search(content.lower())
+
+        if self._attachments:
+            for attachment in message.attachments:
+                ext = os.path.splitext(attachment.filename)[1].lower()
+                matched.update(self._attachments.get(ext, ()))
+
+        return [self.routes[index] for index in sorted(matched)]
+
+    async def _run(self, route, message):
+        start = time.perf_counter()
+        try:
+            await route.handler(message)
+        except Exception:
+            route.errors += 1
+            logging.exception(f"Handler {route.name} failed")
+            if self.on_error:
+                try:
+                    await self.on_error(message, route)
+                except Exception:
+                    logging.exception(f"Error callback for {route.name} failed")
+        finally:
+            route.record(time.perf_counter() - start)
+
+    async def _run_chain(self, routes, message):
+        for route in routes:
+            await self._run(route, message)
+
+    async def dispatch(self, message):
+        routes = self.match(message)
+        if not self.concurrent:
+            await self._run_chain(routes, message)
+            return
+
+        ordered = [route for route in routes if route.ordered]
+        async with asyncio.TaskGroup() as group:
+            if ordered:
+                group.create_task(self._run_chain(ordered, message))
+            for route in routes:
+                if not route.ordered:
+                    group.create_task(self._run(route, message))
+
+    def stats(self):
+        lines = []
+        for route in sorted(self.routes, key=lambda r: r.total_time, reverse=True):
+            avg = route.total_time / route.calls * 1000 if route.calls else 0.0
+            lines.append(f"{route.name}: {route.calls} calls, {route.errors} errors, "
+                         f"avg {avg:.1f}ms, max {route.max_time * 1000:.1f}ms, total {route.total_time:.2f}s")
+        return lines
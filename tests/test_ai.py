@@ -0,0 +1,109 @@
+import asyncio
+import contextlib
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+import ai
+
+BOT = SimpleNamespace(user=SimpleNamespace(id=5))
+PARTS = ['<think>', 'hmm ', 'let me think', '</think>', '\n\nHello', ' there', ', friend', '!']
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(ai, '_client', None)
+    monkeypatch.setattr(ai, '_admitted', 0)
+    monkeypatch.setattr(ai, '_in_flight', {})
+    monkeypatch.setattr(ai, 'AI_MAX_IN_FLIGHT', 1)
+    monkeypatch.setattr(ai, 'AI_MAX_QUEUED', 1)
+    monkeypatch.setattr(ai, 'STREAM_EDIT_INTERVAL', 0)
+    monkeypatch.setattr(ai, 'response_cache', ai.ResponseCache(16, 600))
+    monkeypatch.setattr(ai, 'conversation_history', ai.ConversationHistory(1500, 10, 3600))
+
+
+@asynccontextmanager
+async def fake_ollama(monkeypatch):
+    """
+    Streams PARTS as an ollama chat completion and yields the list of request bodies it received.
+    """
+    requests = []
+
+    async def chat(request):
+        body = await request.json()
+        requests.append(body)
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for part in PARTS + ['']:
+            await asyncio.sleep(0.05)
+            chunk = {'model': body['model'], 'created_at': '2024-01-01T00:00:00Z',
+                     'message': {'role': 'assistant', 'content': part}, 'done': not part}
+            await response.write((json.dumps(chunk) + '\n').encode())
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post('/api/chat', chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    host, port = runner.addresses[0][:2]
+    monkeypatch.setattr(ai, 'OLLAMA_HOST', f'http://{host}:{port}')
+    # Created inside the test's event loop
+    monkeypatch.setattr(ai, '_generation_slots', asyncio.Semaphore(1))
+    try:
+        yield requests
+    finally:
+        await runner.cleanup()
+
+
+def make_message(content, events):
+    """
+    A mention in channel 1, its replies and their edits are recorded in events as ('reply' | 'edit', text).
+    """
+    async def edit(content):
+        events.append(('edit', content))
+
+    async def reply(text):
+        events.append(('reply', text))
+        return SimpleNamespace(edit=edit)
+
+    channel = SimpleNamespace(id=1, typing=contextlib.nullcontext)
+    return SimpleNamespace(content=f'<@{BOT.user.id}> {content}', channel=channel, reply=reply)
+
+
+def test_reply_streams_only_after_think_section(monkeypatch):
+    events = []
+
+    async def main():
+        async with fake_ollama(monkeypatch) as requests:
+            await ai.try_handle_ai(BOT, make_message('hi', events))
+            return requests
+
+    requests = asyncio.run(main())
+    assert len(requests) == 1
+    assert events[0] == ('reply', 'Hello')
+    assert events[-1][1] == 'Hello there, friend!'
+    assert all(kind == 'edit' for kind, _ in events[1:])
+    assert len(events) > 2
+    assert not any('think' in text or 'hmm' in text for _, text in events)
+
+
+def test_full_queue_is_told_to_wait(monkeypatch):
+    events = [[], [], []]
+
+    async def main():
+        async with fake_ollama(monkeypatch) as requests:
+            await asyncio.gather(*(ai.try_handle_ai(BOT, make_message(f'question {i}', events[i]))
+                                   for i in range(3)))
+            return requests
+
+    requests = asyncio.run(main())
+    # One generation runs and one waits for it, the third is over AI_MAX_IN_FLIGHT + AI_MAX_QUEUED
+    assert len(requests) == 2
+    assert events[0][-1][1] == events[1][-1][1] == 'Hello there, friend!'
+    assert events[2] == [('reply', 'Mu aju on praegu täis, proovi natukese aja pärast uuesti!')]
+    assert ai._admitted == 0
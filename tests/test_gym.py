@@ -0,0 +1,100 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from aiohttp import web
+
+import gym
+from dbthread import DbThread
+
+LATENCY = 0.2
+TALLINN = pytz.timezone('Europe/Tallinn')
+
+
+@pytest.fixture(autouse=True)
+def cache_db(tmp_path, monkeypatch):
+    db = DbThread(str(tmp_path / 'gym_cache.db'), 'gym-cache', init=gym._create_tables)
+    monkeypatch.setattr(gym, 'cache_db', db)
+    monkeypatch.setattr(gym, '_session', None)
+    return db
+
+
+@asynccontextmanager
+async def fake_prometheus(monkeypatch):
+    """
+    Serves every instant query after LATENCY seconds and yields the list of queries it received.
+    """
+    queries = []
+
+    async def query(request):
+        queries.append(dict(request.query))
+        await asyncio.sleep(LATENCY)
+        value = '40' if 'max_over_time' in request.query['query'] else '25'
+        return web.json_response({'status': 'success', 'data': {'result': [{'value': [0, value]}]}})
+
+    app = web.Application()
+    app.router.add_get('/api/v1/query', query)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    host, port = runner.addresses[0][:2]
+    monkeypatch.setattr(gym, 'PROMETHEUS_URL', f'http://{host}:{port}')
+    try:
+        yield queries
+    finally:
+        await gym.get_session().close()
+        await gym.cache_db.close()
+        await runner.cleanup()
+
+
+def test_history_queries_run_concurrently(monkeypatch):
+    async def main():
+        async with fake_prometheus(monkeypatch) as queries:
+            start = time.monotonic()
+            history = await gym.get_occupancy_history(datetime.now(TALLINN))
+            return history, time.monotonic() - start, queries
+
+    history, elapsed, queries = asyncio.run(main())
+    assert history == [[40, 40], [25, 25]]
+    assert len(queries) == 4
+    # Four queries one after another would take 4 * LATENCY
+    assert elapsed < 2 * LATENCY
+
+
+def test_past_occupancy_is_cached(monkeypatch):
+    async def main():
+        async with fake_prometheus(monkeypatch) as queries:
+            now = datetime.now(TALLINN)
+            first = await gym.get_occupancy_history(now)
+            first_queries = len(queries)
+            start = time.monotonic()
+            second = await gym.get_occupancy_history(now)
+            return first, second, first_queries, len(queries) - first_queries, time.monotonic() - start
+
+    first, second, first_queries, second_queries, elapsed = asyncio.run(main())
+    assert first == second
+    assert first_queries == 4
+    assert second_queries == 0
+    assert elapsed < LATENCY
+
+
+def test_unfinished_day_and_future_slot_are_not_cached(monkeypatch):
+    async def main():
+        async with fake_prometheus(monkeypatch) as queries:
+            now = datetime.now(TALLINN)
+            for _ in range(2):
+                await gym.get_max_people_count_for_day(now)
+                await gym.get_average_people_count_at_time(now + timedelta(hours=1))
+            return len(queries)
+
+    assert asyncio.run(main()) == 4
+
+
+def test_day_bounds_follow_the_dates_timezone():
+    # Clocks in Tallinn go back an hour on 2026-10-25, so that day is 25 hours long
+    start, end = gym.get_day_bounds(TALLINN.localize(datetime(2026, 10, 25, 12)))
+    assert datetime.fromtimestamp(start, pytz.utc) == datetime(2026, 10, 24, 21, tzinfo=pytz.utc)
+    assert datetime.fromtimestamp(end, pytz.utc) == datetime(2026, 10, 25, 22, tzinfo=pytz.utc)